@@ -3,10 +3,12 @@
 
 
 import logging
+import os
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 from datetime import datetime, timedelta
-from misc import stopwatch_countdown, line_print, init_config, init_logger, init_dbclient
+from misc import stopwatch_countdown, line_print, init_config, init_logger, init_dbclient, ensure_unique_index
 
 
 __version__ = '0.1'
@@ -27,6 +29,37 @@ def get_video_duration(filename):
     return proc.communicate()
 
 
+def probe_file(filename):
+    # Missing files and a missing ffprobe are probed again next loop, only ffprobe failures are stored
+    if not os.path.exists(filename):
+        return None, 'File {0} is missing'.format(filename), False
+    try:
+        out, err = get_video_duration(filename)
+    except OSError as e:
+        return None, 'Running ffprobe failed : {0}'.format(e), False
+    if err:
+        return None, err, True
+    try:
+        return float(out), None, True
+    except ValueError:
+        return None, 'Bad duration {0}'.format(filename), True
+
+
+def get_total_duration(db_link):
+    # Running total is kept in one document, it is rebuilt when it is missing or when a loop was interrupted
+    # between storing a duration and marking it counted
+    files_link = db_link['files']
+    total_doc = db_link['analyse'].find_one({'_id': 'duration'})
+    if total_doc and not files_link.find_one({'duration': {'$type': 'number'}, 'counted': {'$exists': False}}):
+        return total_doc['total']
+    aggregated = list(files_link.aggregate([{'$match': {'duration': {'$type': 'number'}}},
+                                            {'$group': {'_id': None, 'total': {'$sum': '$duration'}}}]))
+    total = aggregated[0]['total'] if aggregated else float(0)
+    db_link['analyse'].update_one({'_id': 'duration'}, {'$set': {'total': total}}, upsert=True)
+    files_link.update_many({'duration': {'$exists': True}, 'counted': {'$exists': False}}, {'$set': {'counted': True}})
+    return total
+
+
 def format_duration(duration):
     sec = timedelta(seconds=int(duration))
     d = datetime(1, 1, 1) + sec
@@ -43,29 +76,41 @@ def print_result(start_time, duration_fmt):
 
 def main():
     wait_timeout = 1200
+    workers = os.cpu_count() or 1
     while Config.getboolean('global', 'loop', fallback=True):
         logging.info('=== START ===')
         start_time = time()
         a_directory = 'files/b/'
         db_link = db_client[db_prefix+'_b']
-        files = db_link['files'].find()
-        index = 0
-        total_duration = float(0)
-        duration_fmt = ''
-        for file in files:
-            index += 1
-            out, err = get_video_duration(a_directory + file['name'])
-            if not err:
-                try:
-                    total_duration += float(out)
-                    duration_fmt = format_duration(total_duration)
-                    out_string = ' [{0}/{1}] Checking {2} {3}'.format(index, files.count(), file['name'], duration_fmt)
-                    line_print(out_string)
-                except ValueError:
-                    logging.warning('Bad duration {0}'.format(file['name']))
-            else:
-                print(err)
-                logging.error(err)
+        files_link = db_link['files']
+        ensure_unique_index(files_link, 'md5')
+        files_link.create_index('duration')
+        total_duration = get_total_duration(db_link)
+        duration_fmt = format_duration(total_duration)
+        # Files never change once downloaded, so only files without a stored duration are probed
+        files = {}
+        for file in files_link.find({'duration': {'$exists': False}}, {'name': 1, 'md5': 1, 'path': 1}):
+            files.setdefault(file['md5'], file)
+        files = list(files.values())
+        logging.info('Probing {0} new files with {1} processes'.format(len(files), workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Files in the shared store are probed by their store path
+            results = executor.map(probe_file, [file.get('path') or a_directory + file['name'] for file in files])
+            for index, (file, (duration, err, probed)) in enumerate(zip(files, results)):
+                if err:
+                    print(err)
+                    logging.error(err)
+                if probed:
+                    # Files ffprobe failed on get a null duration and are not probed again.
+                    # The total is raised before the file is marked counted, see get_total_duration
+                    files_link.update_many({'md5': file['md5']}, {'$set': {'duration': duration}})
+                    if duration:
+                        db_link['analyse'].update_one({'_id': 'duration'}, {'$inc': {'total': duration}})
+                        total_duration += duration
+                        duration_fmt = format_duration(total_duration)
+                    files_link.update_many({'md5': file['md5']}, {'$set': {'counted': True}})
+                out_string = ' [{0}/{1}] Checking {2} {3}'.format(index + 1, len(files), file['name'], duration_fmt)
+                line_print(out_string)
         total_time = print_result(start_time, duration_fmt)
         stopwatch_countdown(wait_timeout - total_time, 'Waiting {0} seconds.'.format(wait_timeout - total_time))
 
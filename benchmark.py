@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import time, sleep
+from timeit import timeit
+from urllib.parse import urlparse, parse_qs
+from misc import strip_message, strip_message_slow, init_http_client
+from metrics import metrics
+import sosach
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+SCENARIOS = ('sequential', 'concurrent', 'pipeline')
+
+
+def load_comments(filenames):
+    # Accepts dumped res/<num>.json threads, parsing_thread_*_failed.json dumps and plain post lists
+    comments = []
+    for filename in filenames:
+        with open(filename) as dump_file:
+            dump = json.load(dump_file)
+        posts = dump['threads'][0]['posts'] if isinstance(dump, dict) else dump
+        comments.extend(post['comment'] for post in posts)
+    return comments
+
+
+def benchmark_strip(args):
+    comments = load_comments(args.files)
+    mismatches = [comment for comment in comments if strip_message(comment) != strip_message_slow(comment)]
+    print('Comments : {0}, mismatches : {1}'.format(len(comments), len(mismatches)))
+    for comment in mismatches[:10]:
+        print('Mismatch : {0!r}'.format(comment))
+    for name, function in (('MLStripper', strip_message_slow), ('strip_message', strip_message)):
+        seconds = timeit(lambda: [function(comment) for comment in comments], number=args.repeat) / args.repeat
+        print('{0:>14} : {1:.3f} s per pass, {2:.1f} us per comment'.format(
+            name, seconds, seconds * 1000000 / max(1, len(comments))))
+
+
+class SyntheticBoard:
+    # Deterministic 2ch-like board, or recorded <fixtures>/threads.json and res/<num>.json
+    comments = ('Просто текст поста',
+                '<a href="/b/res/{thread}.html#{reply}" class="post-reply-link" data-thread="{thread}" '
+                'data-num="{reply}">&gt;&gt;{reply}</a><br>Ответ на пост',
+                '<span class="unkfunc">&gt;цитата</span><br><strong>жирный</strong> и <em>курсив</em>',
+                'Ссылка &amp; текст<br><br><span class="spoiler">спойлер</span>')
+
+    def __init__(self, name, threads, posts, file_size, seed, fixtures=None):
+        self.name = name
+        self.random = random.Random(seed)
+        self.file_size = file_size
+        self.threads = {}
+        self.next_number = 1000
+        self.lock = threading.Lock()
+        if fixtures:
+            self.load_fixtures(fixtures)
+        else:
+            for _ in range(threads):
+                number = self.next_number
+                self.threads[number] = []
+                self.add_posts(number, posts)
+
+    def load_fixtures(self, fixtures):
+        with open(os.path.join(fixtures, 'threads.json')) as threads_file:
+            for parsed_thread in json.load(threads_file)['threads']:
+                with open(os.path.join(fixtures, 'res', '{0}.json'.format(parsed_thread['num']))) as thread_file:
+                    self.threads[int(parsed_thread['num'])] = json.load(thread_file)['threads'][0]['posts']
+        self.next_number = max(int(post['num']) for posts in self.threads.values() for post in posts) + 1
+
+    def add_posts(self, thread_number, count):
+        with self.lock:
+            posts = self.threads[thread_number]
+            for _ in range(count):
+                number = self.next_number
+                self.next_number += 1
+                files = []
+                if self.random.random() < 0.3:
+                    name = '{0}.webm'.format(number)
+                    files.append({'name': name, 'fullname': name, 'type': sosach.FILE_WEBM,
+                                  'path': '/{0}/src/{1}/{2}'.format(self.name, thread_number, name),
+                                  'md5': hashlib.md5(self.get_file(name)).hexdigest(), 'size': self.file_size // 1024,
+                                  'width': 640, 'height': 360, 'duration': '00:00:10'})
+                reply = int(posts[-1]['num']) if posts else number
+                posts.append({'num': str(number),
+                              'number': len(posts) + 1,
+                              'parent': '0' if not posts else str(thread_number),
+                              'timestamp': 1500000000 + number,
+                              'comment': self.random.choice(self.comments).format(thread=thread_number, reply=reply),
+                              'op': 0 if posts else 1,
+                              'files': files})
+
+    def add_random_posts(self, count):
+        numbers = sorted(self.threads)
+        for _ in range(count):
+            self.add_posts(self.random.choice(numbers), 1)
+
+    def get_file(self, name):
+        return (name.encode() * (self.file_size // len(name) + 1))[:self.file_size]
+
+    def get_threads_json(self):
+        with self.lock:
+            return {'board': self.name,
+                    'threads': [{'num': str(number), 'subject': 'Тред', 'timestamp': int(posts[0]['timestamp']),
+                                 'views': len(posts) * 10, 'posts_count': len(posts),
+                                 'lasthit': int(posts[-1]['timestamp'])}
+                                for number, posts in sorted(self.threads.items())]}
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, board, latency):
+        self.board = board
+        self.latency = latency
+        super(ApiServer, self).__init__(('127.0.0.1', 0), ApiRequestHandler)
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        sleep(self.server.latency)
+        board = self.server.board
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts == [board.name, 'threads.json']:
+            return self.send_body(board.get_threads_json())
+        if parts == ['makaba', 'mobile.fcgi']:
+            query = parse_qs(url.query)
+            posts = board.threads.get(int(query['thread'][0]))
+            if posts is not None:
+                return self.send_body([post for post in posts if post['number'] >= int(query['post'][0])])
+        if len(parts) == 3 and parts[:2] == [board.name, 'res']:
+            posts = board.threads.get(int(parts[2].split('.')[0]))
+            if posts is not None:
+                etag = '"{0}"'.format(len(posts))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                return self.send_body({'threads': [{'posts': posts}], 'unique_posters': str(len(posts) // 2 + 1)},
+                                      headers={'ETag': etag})
+        if len(parts) == 4 and parts[:2] == [board.name, 'src']:
+            return self.send_body(board.get_file(parts[3]), 'video/webm')
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def run_scenario(args, scenario, results):
+    # Runs in its own process so peak RSS belongs to this scenario only
+    sys.stdout = open(os.devnull, 'w')
+    logging.basicConfig(level=logging.WARNING)
+    board = SyntheticBoard('b', args.threads, args.posts, args.file_size, args.seed, args.fixtures)
+    server = ApiServer(board, args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sosach.API_URL = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    if args.mongodb == 'mongomock':
+        db_client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        db_client = MongoClient(args.mongodb)
+    db_prefix = 'benchmark_{0}_{1}'.format(scenario, os.getpid())
+    workers = 1 if scenario == 'sequential' else args.workers
+    config = ConfigParser()
+    config.read_dict({'global': {'fetch_workers': workers, 'download_workers': workers, 'requests_per_second': 0}})
+    client = init_http_client(config)
+    directory_name = tempfile.mkdtemp(prefix='boardparser_benchmark_')
+    os.chdir(directory_name)
+    try:
+        for cycle in range(args.cycles):
+            if cycle:
+                board.add_random_posts(args.new_posts)
+            metrics.reset()
+            start_time = time()
+            sosach_board = sosach.SosachBoard('b', client, db_client, db_prefix)
+            with metrics.stage('update_live_threads'):
+                sosach_board.update_live_threads()
+            if scenario == 'pipeline':
+                with metrics.stage('process_live_threads'):
+                    sosach_board.process_live_threads(sosach.FILE_WEBM, workers, workers)
+                with metrics.stage('separate_dead_threads'):
+                    sosach_board.separate_dead_threads()
+            else:
+                with metrics.stage('parse_live_threads'):
+                    sosach_board.parse_live_threads(workers)
+                with metrics.stage('save_live_threads'):
+                    sosach_board.save_live_threads(sosach.FILE_WEBM)
+                with metrics.stage('separate_dead_threads'):
+                    sosach_board.separate_dead_threads()
+                with metrics.stage('download_files'):
+                    sosach_board.download_files(workers)
+            cycle_time = time() - start_time
+            cycle_doc = metrics.get_cycle_doc('b')
+            results.put({'scenario': scenario,
+                         'cycle': cycle,
+                         'seconds': round(cycle_time, 3),
+                         'threads_per_second': round(len(board.threads) / cycle_time, 1),
+                         'posts_per_second': round(sosach_board.new_posts / cycle_time, 1),
+                         'new_posts': sosach_board.new_posts,
+                         'requests': sum(cycle_doc['counters'].get('http_responses', {}).values()),
+                         'downloaded_bytes': cycle_doc['counters'].get('downloaded_bytes', {}).get('all', 0),
+                         'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                         'stages': {stage: round(seconds, 3) for stage, seconds in cycle_doc['stages'].items()}})
+    finally:
+        for name in db_client.list_database_names():
+            if name.startswith(db_prefix):
+                db_client.drop_database(name)
+        server.shutdown()
+        shutil.rmtree(directory_name)
+        results.put(None)
+
+
+def benchmark_cycle(args):
+    if args.mongodb == 'mongomock' and not mongomock:
+        print('mongomock is not installed, use --mongodb with a local MongoDB URI')
+        return
+    output_file = open(args.output, 'a') if args.output else None
+    print('{0:>10} {1:>5} {2:>8} {3:>10} {4:>10} {5:>9} {6:>8}  stages'.format(
+        'scenario', 'cycle', 'seconds', 'threads/s', 'posts/s', 'requests', 'rss MB'))
+    for scenario in args.scenarios.split(','):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario, args=(args, scenario, results))
+        process.start()
+        for result in iter(results.get, None):
+            result['parameters'] = {key: value for key, value in vars(args).items() if key != 'function'}
+            print('{scenario:>10} {cycle:>5} {seconds:>8} {threads_per_second:>10} {posts_per_second:>10} '
+                  '{requests:>9} {peak_rss_mb:>8}  {stages}'.format(**result))
+            if output_file:
+                output_file.write(json.dumps(result) + '\n')
+        process.join()
+    if output_file:
+        output_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='boardparser benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    strip_parser = subparsers.add_parser('strip', help='compare strip_message with MLStripper on dumped threads')
+    strip_parser.add_argument('files', nargs='+', help='dumped thread JSON files')
+    strip_parser.add_argument('--repeat', type=int, default=5)
+    strip_parser.set_defaults(function=benchmark_strip)
+    cycle_parser = subparsers.add_parser('cycle', help='run full board cycles against a local 2ch API stand-in')
+    cycle_parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, of ' +
+                              ', '.join(SCENARIOS))
+    cycle_parser.add_argument('--threads', type=int, default=200, help='synthetic threads on the board')
+    cycle_parser.add_argument('--posts', type=int, default=100, help='synthetic posts per thread')
+    cycle_parser.add_argument('--new-posts', type=int, default=500, help='posts added before every next cycle')
+    cycle_parser.add_argument('--file-size', type=int, default=256 * 1024, help='synthetic webm size in bytes')
+    cycle_parser.add_argument('--fixtures', help='directory with recorded threads.json and res/<num>.json')
+    cycle_parser.add_argument('--latency', type=float, default=0.05, help='server latency per request in seconds')
+    cycle_parser.add_argument('--workers', type=int, default=8, help='fetch and download workers')
+    cycle_parser.add_argument('--cycles', type=int, default=3)
+    cycle_parser.add_argument('--seed', type=int, default=1)
+    cycle_parser.add_argument('--mongodb', default='mongomock', help='MongoDB URI or mongomock')
+    cycle_parser.add_argument('--output', help='append results as JSON lines to this file')
+    cycle_parser.set_defaults(function=benchmark_cycle)
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        return
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import logging
+import os
+import threading
+from time import time, strftime, gmtime
+
+
+class CaptureWriter:
+    # Appends raw API responses to <directory>/<board>/<time>-<pid>.jsonl.gz segments,
+    # every flushed record gets a line in <directory>/<board>/index.jsonl
+    def __init__(self, directory_name, segment_size=64 * 1024 * 1024):
+        self.directory_name = directory_name
+        self.segment_size = segment_size
+        self.segments = {}
+        self.lock = threading.Lock()
+
+    def get_segment(self, board_name):
+        segment = self.segments.get(board_name)
+        if segment and segment['size'] >= self.segment_size:
+            self.close_segment(board_name)
+            segment = None
+        if not segment:
+            directory_name = os.path.join(self.directory_name, board_name)
+            if not os.path.exists(directory_name):
+                os.makedirs(directory_name)
+            name = '{0}-{1}.jsonl.gz'.format(strftime('%Y%m%d-%H%M%S', gmtime()), os.getpid())
+            segment = {'name': name,
+                       'file': gzip.open(os.path.join(directory_name, name), 'ab'),
+                       'size': 0,
+                       'index': []}
+            self.segments[board_name] = segment
+        return segment
+
+    def write(self, board_name, kind, thread_number, url, text):
+        record_time = time()
+        line = json.dumps({'board': board_name,
+                           'kind': kind,
+                           'thread': thread_number,
+                           'time': record_time,
+                           'url': url,
+                           'body': text}, ensure_ascii=False).encode() + b'\n'
+        with self.lock:
+            segment = self.get_segment(board_name)
+            segment['file'].write(line)
+            segment['size'] += len(line)
+            segment['index'].append({'segment': segment['name'], 'kind': kind, 'thread': thread_number,
+                                     'time': record_time})
+
+    def flush(self):
+        # Index lines are written only for records already flushed to their segment
+        with self.lock:
+            for board_name, segment in self.segments.items():
+                segment['file'].flush()
+                self.write_index(board_name, segment)
+
+    def close(self):
+        with self.lock:
+            for board_name in list(self.segments):
+                self.close_segment(board_name)
+
+    def close_segment(self, board_name):
+        segment = self.segments.pop(board_name)
+        segment['file'].close()
+        self.write_index(board_name, segment)
+
+    def write_index(self, board_name, segment):
+        if not segment['index']:
+            return
+        with open(os.path.join(self.directory_name, board_name, 'index.jsonl'), 'a') as index_file:
+            for entry in segment['index']:
+                index_file.write(json.dumps(entry) + '\n')
+        segment['index'] = []
+
+
+class CaptureReader:
+    def __init__(self, directory_name):
+        self.directory_name = directory_name
+
+    def get_segments(self, board_name, thread_number=None, since=None, until=None):
+        # Segments holding matching records, in time order
+        segments = {}
+        index_filename = os.path.join(self.directory_name, board_name, 'index.jsonl')
+        if not os.path.exists(index_filename):
+            logging.warning('No capture index for /{0}/'.format(board_name))
+            return []
+        with open(index_filename) as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                if since and entry['time'] < since or until and entry['time'] > until:
+                    continue
+                # threads.json records are kept for thread metadata
+                if thread_number and entry['thread'] not in (thread_number, None):
+                    continue
+                segments[entry['segment']] = min(entry['time'], segments.get(entry['segment'], entry['time']))
+        return sorted(segments, key=segments.get)
+
+    def read(self, board_name, thread_number=None, since=None, until=None):
+        for segment_name in self.get_segments(board_name, thread_number, since, until):
+            with gzip.open(os.path.join(self.directory_name, board_name, segment_name), 'rb') as segment_file:
+                try:
+                    for line in segment_file:
+                        record = json.loads(line.decode())
+                        if since and record['time'] < since or until and record['time'] > until:
+                            continue
+                        if thread_number and record['thread'] not in (thread_number, None):
+                            continue
+                        yield record
+                except (EOFError, ValueError):
+                    # Segment of a killed process ends with a cut record
+                    logging.warning('Capture segment {0} is truncated'.format(segment_name))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from time import time, sleep
+from urllib.parse import urlparse
+from requests import ConnectionError, Timeout
+from metrics import metrics
+
+# Responses retried after a backoff, 429 and 503 also slow down the request rate
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+class TokenBucket:
+    # Requests per second cap shared between threads with bursts up to capacity requests, 0 means no limit.
+    # The rate is halved when the server throttles and grows back to the cap with successful requests
+    rate_increase = 0.01
+
+    def __init__(self, rate, capacity=1, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = rate / 10 if min_rate is None else min_rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.last_time = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            # Negative tokens reserve the next free slots, so waiting threads keep their order
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            sleep(delay)
+
+    def throttle(self):
+        if not self.rate:
+            return
+        with self.lock:
+            rate = max(self.min_rate, self.rate / 2)
+            if rate < self.rate:
+                logging.warning('Server is throttling, request rate lowered to {0:.2f} per second'.format(rate))
+            self.rate = rate
+
+    def recover(self):
+        if self.rate and self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.rate_increase)
+
+
+class HttpClient:
+    # Rate limited and retrying GET over a pooled session, shared by all boards and threads
+    def __init__(self, session, rate_limiter=None, timeout=5, retries=3, backoff=0.5, max_backoff=30,
+                 host_connections=0):
+        self.session = session
+        self.rate_limiter = rate_limiter or TokenBucket(0)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Concurrent requests per host, 0 means only the connection pool size limits them
+        self.host_connections = host_connections
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        self.connection_stats = {'connections': 0, 'requests': 0}
+
+    def get_host_semaphore(self, host):
+        if not self.host_connections:
+            return None
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_connections)
+            return self.host_semaphores[host]
+
+    def get_retry_delay(self, attempt, response):
+        # Retry-After of the server if it sent one, jittered exponential backoff otherwise
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time()
+                except (TypeError, ValueError):
+                    delay = 0
+            if delay > 0:
+                return min(self.max_backoff, delay)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, **kwargs):
+        # Timeouts, connection errors and retryable codes are retried, the last error or response is returned
+        kwargs.setdefault('timeout', self.timeout)
+        semaphore = self.get_host_semaphore(urlparse(url).netloc)
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            response = None
+            error = None
+            if semaphore:
+                semaphore.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                error = e
+            finally:
+                if semaphore:
+                    semaphore.release()
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                self.rate_limiter.recover()
+                return response
+            if attempt == self.retries:
+                if error:
+                    raise error
+                return response
+            if response is not None and response.status_code in THROTTLE_STATUS_CODES:
+                self.rate_limiter.throttle()
+            delay = self.get_retry_delay(attempt, response)
+            logging.debug('Requesting {0} failed : {1}, retrying in {2:.1f} seconds'.format(
+                url, error or 'HTTP code is {0}'.format(response.status_code), delay))
+            metrics.add('http_retries')
+            if response is not None:
+                response.close()
+            sleep(delay)
+
+    def report_connections(self):
+        # New connections against requests sent since the last report, a low reuse means keep-alive is not working
+        connections = 0
+        requests = 0
+        for adapter in {id(adapter): adapter for adapter in self.session.adapters.values()}.values():
+            pools = getattr(adapter, 'poolmanager', None)
+            for key in (pools.pools.keys() if pools else ()):
+                pool = pools.pools.get(key)
+                if pool:
+                    connections += pool.num_connections
+                    requests += pool.num_requests
+        new_connections = max(0, connections - self.connection_stats['connections'])
+        new_requests = max(0, requests - self.connection_stats['requests'])
+        self.connection_stats = {'connections': connections, 'requests': requests}
+        metrics.add('http_connections', new_connections)
+        metrics.add('http_pooled_requests', new_requests)
+        if new_requests:
+            logging.info('Opened {0} connections for {1} requests, {2:.0%} reused'.format(
+                new_connections, new_requests, 1 - new_connections / new_requests))
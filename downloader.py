@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import random
+from time import sleep
+from requests import RequestException
+from metrics import metrics
+
+
+class FileDownloader:
+    chunk_size = 64 * 1024
+    request_timeout = 30
+    retries = 3
+    retry_wait_timeout = 2
+
+    def __init__(self, requests_session, directory_name):
+        self.requests_session = requests_session
+        self.directory_name = directory_name
+        if not os.path.exists(directory_name):
+            os.makedirs(directory_name)
+
+    def download(self, file, path=None):
+        # Streams into name.part and renames it only when md5 matches, a left .part is resumed next time.
+        # Returns None if the file is gone from the server and retrying is pointless
+        path = path or os.path.join(self.directory_name, file['name'])
+        part_path = path + '.part'
+        for attempt in range(1, self.retries + 1):
+            try:
+                result = self.download_part(file['url'], part_path, file.get('md5'))
+                if result:
+                    os.replace(part_path, path)
+                    metrics.add('downloaded_files')
+                    return True
+                if result is None:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    metrics.add('failed_files')
+                    return None
+            except (RequestException, OSError) as e:
+                logging.warning('Downloading {0} failed on attempt {1}/{2} : {3}'.format(file['url'], attempt,
+                                                                                       self.retries, e))
+            if attempt < self.retries:
+                sleep(self.retry_wait_timeout * attempt * random.uniform(0.5, 1.5))
+        logging.error('Downloading {0} failed'.format(file['url']))
+        metrics.add('failed_files')
+        return False
+
+    def download_part(self, url, part_path, md5):
+        md5_hash = hashlib.md5()
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+        response = self.requests_session.get(url, headers=headers, stream=True, timeout=self.request_timeout)
+        try:
+            if response.status_code == 206:
+                with open(part_path, 'rb') as part_file:
+                    for chunk in iter(lambda: part_file.read(self.chunk_size), b''):
+                        md5_hash.update(chunk)
+                mode = 'ab'
+            elif response.status_code == 200:
+                mode = 'wb'
+            elif response.status_code == 416 and offset:
+                # Part is already complete
+                with open(part_path, 'rb') as part_file:
+                    for chunk in iter(lambda: part_file.read(self.chunk_size), b''):
+                        md5_hash.update(chunk)
+                return self.check_md5(url, part_path, md5_hash, md5)
+            elif 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                # Deleted files answer 404 or 403, they never come back
+                logging.warning('Downloading {0} failed for good. HTTP code is {1}'.format(url,
+                                                                                         response.status_code))
+                return None
+            else:
+                logging.warning('Downloading {0} failed. HTTP code is {1}'.format(url, response.status_code))
+                return False
+            with open(part_path, mode) as part_file:
+                for chunk in response.iter_content(self.chunk_size):
+                    part_file.write(chunk)
+                    md5_hash.update(chunk)
+                    metrics.add('downloaded_bytes', len(chunk))
+        finally:
+            response.close()
+        return self.check_md5(url, part_path, md5_hash, md5)
+
+    @staticmethod
+    def check_md5(url, part_path, md5_hash, md5):
+        if not md5 or md5_hash.hexdigest() == md5.lower():
+            return True
+        logging.warning('MD5 of {0} does not match, discarding it'.format(url))
+        os.remove(part_path)
+        return False
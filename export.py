@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from time import time, strftime, gmtime
+from bson import ObjectId
+from pymongo import ReadPreference
+from misc import line_print, init_config, init_logger, init_dbclient
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__version__ = '0.1'
+
+Config = init_config('config.conf')
+Config.set('global', 'log_file_prefix', 'export')
+init_logger(Config)
+
+db_client = init_dbclient(Config)
+db_prefix = Config.get('global', 'database_prefix', fallback='boardparser')
+
+COLLECTIONS = ('threads', 'posts', 'dead_threads', 'dead_posts', 'files')
+# Files have no timestamp, they are split by the day they were downloaded
+DAY_FIELDS = {'files': 'date'}
+# Parquet columns, nested fields are kept as JSON strings and other fields are dropped
+THREAD_COLUMNS = (('board_name', 'string'), ('number', 'int64'), ('subject', 'string'), ('timestamp', 'int64'),
+                  ('views', 'int64'), ('unique_posters', 'int64'), ('replies', 'int64'))
+POST_COLUMNS = (('thread', 'int64'), ('number', 'int64'), ('index', 'int64'), ('timestamp', 'int64'),
+                ('op', 'int64'), ('message', 'string'), ('files', 'json'), ('replies_to', 'int64_list'),
+                ('replies', 'int64'))
+FILE_COLUMNS = (('name', 'string'), ('md5', 'string'), ('date', 'int64'), ('duration', 'float64'))
+COLUMNS = {'threads': THREAD_COLUMNS,
+           'dead_threads': THREAD_COLUMNS,
+           'posts': POST_COLUMNS,
+           'dead_posts': POST_COLUMNS,
+           'files': FILE_COLUMNS}
+
+
+def get_day(timestamp):
+    return strftime('%Y-%m-%d', gmtime(timestamp))
+
+
+class JsonlPartWriter:
+    extension = '.jsonl.gz'
+
+    def __init__(self, filename, columns):
+        self.file = gzip.open(filename, 'wt', encoding='utf-8')
+
+    def write(self, doc):
+        self.file.write(json.dumps(doc, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPartWriter:
+    extension = '.parquet'
+    row_group_size = 10000
+
+    def __init__(self, filename, columns):
+        types = {'string': pyarrow.string(),
+                 'json': pyarrow.string(),
+                 'int64': pyarrow.int64(),
+                 'float64': pyarrow.float64(),
+                 'int64_list': pyarrow.list_(pyarrow.int64())}
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, types[column_type]) for name, column_type in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression='zstd')
+        self.rows = {name: [] for name, column_type in columns}
+        self.rows_count = 0
+
+    def write(self, doc):
+        for name, column_type in self.columns:
+            value = doc.get(name)
+            if column_type == 'json' and value is not None:
+                value = json.dumps(value, ensure_ascii=False)
+            self.rows[name].append(value)
+        self.rows_count += 1
+        if self.rows_count >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows_count:
+            self.writer.write_table(pyarrow.Table.from_pydict(self.rows, schema=self.schema))
+            self.rows = {name: [] for name in self.rows}
+            self.rows_count = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def load_state(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as state_file:
+        return json.load(state_file)
+
+
+def save_state(filename, state):
+    with open(filename + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def remove_unfinished_parts(directory_name):
+    # Parts of an interrupted export were never counted in the state, they are exported again
+    for path, directories, filenames in os.walk(directory_name):
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                os.remove(os.path.join(path, filename))
+
+
+def finish_parts(directory_name, state_filename, state):
+    # Parts are renamed once the state counts them, renames interrupted by a crash are done on the next run
+    for part_name in state.pop('pending_parts', []):
+        part_filename = os.path.join(directory_name, part_name)
+        if os.path.exists(part_filename):
+            os.replace(part_filename, part_filename[:-len('.tmp')])
+    save_state(state_filename, state)
+
+
+def export_collection(link, directory_name, collection, writer_class, state, args):
+    # Documents are exported in insertion (_id) order after the high-water mark of the last run.
+    # Documents younger than lag seconds are left for the next run, so concurrent inserts are not skipped
+    id_query = {'$lt': ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=args.lag))}
+    if state.get(collection):
+        id_query['$gt'] = ObjectId(state[collection])
+    day_field = DAY_FIELDS.get(collection, 'timestamp')
+    run_name = strftime('%Y%m%d-%H%M%S', gmtime())
+    writers = {}
+    part_filenames = []
+    docs_count = 0
+    last_id = None
+    for doc in link.find({'_id': id_query}).sort('_id', 1).batch_size(args.batch_size):
+        last_id = doc.pop('_id')
+        day = get_day(doc.get(day_field) or last_id.generation_time.timestamp())
+        writer = writers.get(day)
+        if not writer:
+            # Old archives span many days, the least recently opened part is finished first
+            if len(writers) >= args.max_open_files:
+                writers.pop(next(iter(writers))).close()
+            day_directory_name = os.path.join(directory_name, collection, 'day={0}'.format(day))
+            if not os.path.exists(day_directory_name):
+                os.makedirs(day_directory_name)
+            part_filename = os.path.join(day_directory_name, 'part-{0}-{1}{2}.tmp'.format(
+                run_name, len(part_filenames), writer_class.extension))
+            writer = writer_class(part_filename, COLUMNS[collection])
+            writers[day] = writer
+            part_filenames.append(part_filename)
+        writer.write(doc)
+        docs_count += 1
+        if docs_count % args.batch_size == 0:
+            line_print(' Exported {0} documents from {1}'.format(docs_count, link.full_name))
+    for writer in writers.values():
+        writer.close()
+    if last_id:
+        state[collection] = str(last_id)
+    state['pending_parts'] = [os.path.relpath(part_filename, directory_name) for part_filename in part_filenames]
+    return docs_count
+
+
+def export_board(board_name, args):
+    start_time = time()
+    writer_class = ParquetPartWriter if args.format == 'parquet' else JsonlPartWriter
+    db_link = db_client['{0}_{1}'.format(db_prefix, board_name)]
+    directory_name = os.path.join(args.output, board_name)
+    if not os.path.exists(directory_name):
+        os.makedirs(directory_name)
+    state_filename = os.path.join(directory_name, 'state-{0}.json'.format(args.format))
+    state = load_state(state_filename)
+    finish_parts(directory_name, state_filename, state)
+    remove_unfinished_parts(directory_name)
+    if args.full:
+        state = {}
+    for collection in args.collections:
+        # Secondaries take the export reads off the primary the crawler writes to, when there are any
+        link = db_link[collection].with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        docs_count = export_collection(link, directory_name, collection, writer_class, state, args)
+        # New mark is saved with its parts before they are renamed, so a crash does not export them twice
+        save_state(state_filename, state)
+        finish_parts(directory_name, state_filename, state)
+        line_print('')
+        logging.info('Exported {0} new documents from {1}'.format(docs_count, link.full_name))
+    logging.info('Exported /{0}/ in {1} seconds'.format(board_name, int(time() - start_time)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export board collections to day partitioned files')
+    parser.add_argument('boards', nargs='+')
+    parser.add_argument('--output', default='export')
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl')
+    parser.add_argument('--collections', nargs='+', choices=COLLECTIONS, default=COLLECTIONS)
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents fetched per cursor batch')
+    parser.add_argument('--max-open-files', type=int, default=32, help='day partitions written at once')
+    parser.add_argument('--lag', type=int, default=60, help='seconds before new documents are exported')
+    parser.add_argument('--full', action='store_true', help='export everything again, ignoring the last run')
+    args = parser.parse_args()
+    if args.format == 'parquet' and not pyarrow:
+        parser.error('pyarrow is not installed, use --format jsonl')
+    for board_name in args.boards:
+        export_board(board_name, args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        line_print('=== User exit ===')
+        exit()
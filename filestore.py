@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import socket
+from time import time, sleep
+from pymongo.errors import DuplicateKeyError
+from metrics import metrics
+from misc import line_print, init_config, init_logger, init_dbclient
+
+MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_file_md5(path, chunk_size=64 * 1024):
+    md5_hash = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+class FileStore:
+    # Content addressed store <directory>/<md5[:2]>/<md5[2:4]>/<md5><ext> shared by all boards.
+    # The global index keeps {_id: md5, state, path, size, name, boards}, board directories get hardlinks
+    # and board files documents keep the store path
+    claim_timeout = 600
+    claim_wait = 1
+
+    def __init__(self, directory_name, collection, boards_directory_name='files', links=True):
+        self.directory_name = directory_name
+        self.collection = collection
+        self.boards_directory_name = boards_directory_name
+        self.links = links
+        self.worker_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    def get_path(self, md5, name):
+        return os.path.join(self.directory_name, md5[:2], md5[2:4], md5 + os.path.splitext(name)[1].lower())
+
+    def get_file_path(self, file):
+        # Store path of a file, None if it has no usable md5 and stays in its board directory
+        md5 = (file.get('md5') or '').lower()
+        return self.get_path(md5, file['name']) if MD5_RE.match(md5) else None
+
+    def get_stored_path(self, md5):
+        stored = self.collection.find_one({'_id': md5, 'state': 'stored'}, {'path': 1})
+        if not stored:
+            return None
+        if os.path.exists(stored['path']):
+            return stored['path']
+        # Stored copy was removed from disk, it is downloaded again
+        self.collection.delete_one({'_id': md5, 'state': 'stored'})
+        return None
+
+    def claim(self, md5):
+        # True if this worker has to download the file, False if it is stored or downloaded by another worker
+        now = time()
+        try:
+            self.collection.find_one_and_update(
+                {'_id': md5, 'state': 'downloading',
+                 '$or': [{'owner': self.worker_id}, {'claimed': {'$lt': now - self.claim_timeout}}]},
+                {'$set': {'state': 'downloading', 'owner': self.worker_id, 'claimed': now}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def set_stored(self, md5, path, name, board_name):
+        self.collection.update_one({'_id': md5},
+                                   {'$set': {'state': 'stored', 'path': path, 'size': os.path.getsize(path),
+                                             'name': name},
+                                    '$unset': {'owner': '', 'claimed': ''},
+                                    '$addToSet': {'boards': board_name}},
+                                   upsert=True)
+
+    def fetch(self, downloader, file, board_name):
+        # Same content is downloaded once for all boards, file['path'] is set to the stored copy
+        md5 = (file.get('md5') or '').lower()
+        if not MD5_RE.match(md5):
+            return downloader.download(file)
+        while True:
+            path = self.get_stored_path(md5)
+            if path:
+                self.collection.update_one({'_id': md5}, {'$addToSet': {'boards': board_name}})
+                metrics.add('deduplicated_files')
+                break
+            if self.claim(md5):
+                path = self.get_path(md5, file['name'])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                result = downloader.download(file, path)
+                if not result:
+                    self.collection.delete_one({'_id': md5, 'state': 'downloading', 'owner': self.worker_id})
+                    return result
+                self.set_stored(md5, path, file['name'], board_name)
+                break
+            # Another worker downloads it, wait until it is stored, released on failure or its claim expires
+            logging.debug('File {0} is downloaded by another worker, waiting'.format(file['name']))
+            sleep(self.claim_wait)
+        self.link(path, board_name, file['name'])
+        file['path'] = path
+        return True
+
+    def link(self, path, board_name, name):
+        if not self.links:
+            return
+        board_path = os.path.join(self.boards_directory_name, board_name, name)
+        if os.path.exists(board_path):
+            return
+        os.makedirs(os.path.dirname(board_path), exist_ok=True)
+        try:
+            os.link(path, board_path)
+        except OSError as e:
+            logging.warning('Linking {0} to {1} failed : {2}'.format(path, board_path, e))
+
+    def migrate_board(self, db_link, board_name):
+        # Offline move of files/<board>/<name> into the store, with the crawler stopped.
+        # Names stay as hardlinks to the stored copy, or are removed if links are disabled
+        counters = {'files': 0, 'moved': 0, 'deduplicated': 0, 'missing': 0}
+        for file_doc in db_link['files'].find({'path': {'$exists': False}}, {'name': 1, 'md5': 1}):
+            counters['files'] += 1
+            board_path = os.path.join(self.boards_directory_name, board_name, file_doc['name'])
+            if not os.path.exists(board_path):
+                counters['missing'] += 1
+                continue
+            # Content is hashed again, API md5 may be missing or wrong
+            md5 = get_file_md5(board_path)
+            path = self.get_stored_path(md5)
+            if path:
+                if not os.path.samefile(path, board_path):
+                    self.replace_with_link(path, board_path)
+                    counters['deduplicated'] += 1
+                self.collection.update_one({'_id': md5}, {'$addToSet': {'boards': board_name}})
+            else:
+                path = self.get_path(md5, file_doc['name'])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.links:
+                    self.replace_with_link(board_path, path)
+                else:
+                    os.replace(board_path, path)
+                self.set_stored(md5, path, file_doc['name'], board_name)
+                counters['moved'] += 1
+            db_link['files'].update_one({'_id': file_doc['_id']}, {'$set': {'path': path}})
+            line_print(' [{0}] Migrating /{1}/ files, {2} moved, {3} deduplicated'.format(
+                counters['files'], board_name, counters['moved'], counters['deduplicated']))
+        line_print('')
+        return counters
+
+    def replace_with_link(self, path, link_path):
+        if not self.links:
+            os.remove(link_path)
+            return
+        os.link(path, link_path + '.tmp')
+        os.replace(link_path + '.tmp', link_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move downloaded files of boards into the shared file store')
+    parser.add_argument('boards', nargs='+')
+    args = parser.parse_args()
+    config = init_config('config.conf')
+    config.set('global', 'log_file_prefix', 'filestore')
+    init_logger(config)
+    db_client = init_dbclient(config)
+    db_prefix = config.get('global', 'database_prefix', fallback='boardparser')
+    file_store = FileStore(config.get('global', 'file_store', fallback='files/store'),
+                           db_client[db_prefix]['files'],
+                           links=config.getboolean('global', 'file_store_links', fallback=True))
+    for board_name in args.boards:
+        start_time = time()
+        counters = file_store.migrate_board(db_client['{0}_{1}'.format(db_prefix, board_name)], board_name)
+        logging.info('Migrated {0} files of /{1}/ in {2} seconds: {3} moved, {4} deduplicated, {5} missing'.format(
+            counters['files'], board_name, int(time() - start_time), counters['moved'], counters['deduplicated'],
+            counters['missing']))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        line_print('=== User exit ===')
+        exit()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import socket
+import threading
+from time import time, sleep
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+
+class LeaseManager:
+    # Leases are documents {_id: name, owner, expires}, an expired lease can be taken by any worker.
+    # A lease is held during a cycle, then kept by its owner until the next cycle so others do not poll it earlier
+    def __init__(self, collection, lease_timeout, names_count, max_leases=0):
+        self.collection = collection
+        self.lease_timeout = lease_timeout
+        self.names_count = names_count
+        self.max_leases = max_leases
+        self.worker_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        # Every worker holds a lease named after itself, so idle workers count in fair shares too
+        self.collection.update_one({'_id': self.worker_id},
+                                   {'$set': {'owner': self.worker_id, 'expires': time() + lease_timeout}}, upsert=True)
+        self.leases = {self.worker_id}
+        self.lock = threading.Lock()
+        self.heartbeat = threading.Thread(target=self.renew_leases, daemon=True)
+        self.heartbeat.start()
+
+    def get_max_leases(self, now):
+        # Fair share of names between workers owning leases, unless max_leases is set
+        if self.max_leases:
+            return self.max_leases
+        workers = set(self.collection.distinct('owner', {'expires': {'$gt': now}}))
+        workers.add(self.worker_id)
+        return -(-self.names_count // len(workers))
+
+    def acquire(self, name):
+        with self.lock:
+            now = time()
+            # Workers over their share let leases expire, so new workers get them
+            leases_count = self.collection.count_documents({'_id': {'$nin': [name, self.worker_id]},
+                                                            'owner': self.worker_id, 'expires': {'$gt': now}})
+            if leases_count >= self.get_max_leases(now):
+                return False
+            try:
+                old_lease = self.collection.find_one_and_update(
+                    {'_id': name, '$or': [{'owner': self.worker_id}, {'expires': {'$lt': now}}]},
+                    {'$set': {'owner': self.worker_id, 'expires': now + self.lease_timeout}},
+                    upsert=True, return_document=ReturnDocument.BEFORE)
+            except DuplicateKeyError:
+                # Lease exists and is held by a live worker
+                return False
+            if old_lease and old_lease['owner'] != self.worker_id:
+                logging.info('Lease {0} of {1} expired, taken over by {2}'.format(name, old_lease['owner'],
+                                                                                 self.worker_id))
+            elif not old_lease:
+                logging.info('Lease {0} acquired by {1}'.format(name, self.worker_id))
+            self.leases.add(name)
+            return True
+
+    def release(self, name, next_time):
+        # Lease is not renewed anymore, any worker can take it after next_time
+        with self.lock:
+            self.leases.discard(name)
+            self.collection.update_one({'_id': name, 'owner': self.worker_id}, {'$set': {'expires': next_time}})
+
+    def release_all(self):
+        with self.lock:
+            self.collection.delete_many({'owner': self.worker_id})
+            self.leases.clear()
+
+    def renew_leases(self):
+        while True:
+            sleep(self.lease_timeout / 3)
+            with self.lock:
+                for name in list(self.leases):
+                    try:
+                        result = self.collection.update_one({'_id': name, 'owner': self.worker_id},
+                                                            {'$set': {'expires': time() + self.lease_timeout}})
+                    except PyMongoError as e:
+                        logging.error('Renewing lease {0} failed : {1}'.format(name, e))
+                        continue
+                    if not result.matched_count:
+                        logging.warning('Lease {0} was lost by {1}'.format(name, self.worker_id))
+                        self.leases.discard(name)
@@ -3,10 +3,15 @@
 
 
 import logging
-import requests
-from time import time, strftime, gmtime
-from misc import stopwatch_countdown, line_print, init_config, init_logger, init_dbclient
+from time import time
+from misc import stopwatch_countdown, line_print, init_config, init_logger, init_dbclient, init_http_client
+from capture import CaptureWriter
+from filestore import FileStore
+from lease import LeaseManager
+from metrics import metrics
+from scheduler import Scheduler
 from sosach import SosachBoard
+from wordindex import WordIndex
 
 __version__ = '0.1'
 
@@ -19,42 +24,109 @@ db_client = init_dbclient(Config)
 db_prefix = Config.get('global', 'database_prefix', fallback='boardparser')
 
 
-def analyze_word_list_live(board):
-    # WLink = DBLink['raw_words']
-    words = []
-    logging.info('Gathering word list')
-    for thread in board.threads:
-        for post in thread.posts:
-            for word in post.message.split(' '):
-                words.append(word)
-    logging.info('Read {0} words'.format(len(words)))
-    # with open('log/word_list_{0}.txt'.format(strftime('%d.%m.%y_%H:%M', gmtime())), 'w') as word_list_file:
-    #    word_list_file.write('\n'.join(words))
+def run_board_cycle(board):
+    fetch_workers = Config.getint('global', 'fetch_workers', fallback=8)
+    incremental_polling = Config.getboolean('global', 'incremental_polling', fallback=True)
+    download_workers = Config.getint('global', 'download_workers', fallback=4)
+    pipeline = Config.getboolean('global', 'pipeline', fallback=False)
+    pipeline_queue_size = Config.getint('global', 'pipeline_queue_size', fallback=64)
+    board.measure_memory = Config.getboolean('global', 'measure_memory', fallback=False)
+    with metrics.stage('update_live_threads'):
+        if not board.update_live_threads():
+            return False
+    if pipeline:
+        with metrics.stage('process_live_threads'):
+            board.process_live_threads(6, fetch_workers, download_workers, incremental_polling, pipeline_queue_size)
+    else:
+        with metrics.stage('parse_live_threads'):
+            board.parse_live_threads(fetch_workers, incremental_polling)
+        with metrics.stage('save_live_threads'):
+            board.save_live_threads(6)
+    with metrics.stage('separate_dead_threads'):
+        board.separate_dead_threads()
+    if not pipeline:
+        with metrics.stage('download_files'):
+            board.download_files(download_workers)
+    return True
+
+
+def run_schedule(scheduler, schedule, client, capture=None, file_store=None):
+    logging.info('=== START /{0}/ ==='.format(schedule.name))
+    start_time = time()
+    metrics.reset()
+    board = SosachBoard(schedule.board, client, db_client, db_prefix)
+    board.shard = (schedule.shard, schedule.shards)
+    board.capture = capture
+    board.file_store = file_store
+    # New posts are added to the board word index as they are saved
+    if Config.getboolean('global', 'word_index', fallback=False):
+        board.word_index = WordIndex(board.db_link)
+    if not run_board_cycle(board):
+        # Other boards keep their schedule, this one is retried after the fallback timeout
+        logging.warning('=== SKIP /{0}/, live threads are unknown ==='.format(schedule.name))
+        scheduler.postpone(schedule)
+        return
+    if capture:
+        capture.flush()
+    total_time = int(time() - start_time)
+    logging.info('Total work time is {0} seconds'.format(total_time))
+    metrics.add('new_threads', board.new_threads)
+    metrics.add('new_posts', board.new_posts)
+    metrics.add('unchanged_threads', board.unchanged_threads)
+    client.report_connections()
+    metrics.finish_cycle(schedule.name, board.db_link['stats'], Config.get('global', 'metrics_file', fallback=''))
+    logging.info('=== STOP /{0}/ ==='.format(schedule.name))
+    scheduler.update(schedule, start_time, board.new_posts)
 
 
 def main():
     wait_timeout = Config.getint('global', 'wait_timeout', fallback=600)
     wait_timeout_fallback = Config.getint('global', 'wait_timeout_fallback', fallback=60)
-    while Config.getboolean('global', 'loop', fallback=True):
-        logging.info('=== START ===')
-        start_time = time()
-        requests_session = requests.Session()
-        board = SosachBoard('b', requests_session, db_client, db_prefix)
-        board.update_live_threads()
-        board.parse_live_threads()
-        board.save_live_threads()
-        board.separate_dead_threads()
-        board.download_files(6)
-        total_time = int(time() - start_time)
-        # analyze_word_list_live(board)
-        logging.info('Total work time is {0} seconds'.format(total_time))
-        logging.info('=== STOP ===')
-        if total_time < wait_timeout:
-            stopwatch_countdown(wait_timeout - total_time, 'Waiting {0} seconds.'.format(wait_timeout - total_time))
-        else:
-            logging.warning('Writing board time is longer than wait timeout')
-            stopwatch_countdown(wait_timeout_fallback, 'Waiting {0} seconds.'.format(wait_timeout_fallback))
-        Config.read('config.conf')
+    # Boards are polled between min_wait_timeout and wait_timeout to get about target_new_posts per cycle
+    min_wait_timeout = Config.getint('global', 'min_wait_timeout', fallback=wait_timeout)
+    target_new_posts = Config.getint('global', 'target_new_posts', fallback=100)
+    boards = [name.strip() for name in Config.get('global', 'boards', fallback='b').split(',') if name.strip()]
+    shards = Config.getint('global', 'shards', fallback=1)
+    scheduler = Scheduler(boards, min_wait_timeout, wait_timeout, target_new_posts, wait_timeout_fallback, shards)
+    # One connection pool and one request budget for all boards
+    client = init_http_client(Config)
+    # Worker mode, several processes split board shards using leases in MongoDB, max_leases 0 gives each a fair share
+    lease_manager = None
+    if Config.getboolean('global', 'leases', fallback=False):
+        lease_manager = LeaseManager(db_client[db_prefix]['leases'],
+                                     Config.getint('global', 'lease_timeout', fallback=1800),
+                                     len(scheduler.schedules),
+                                     Config.getint('global', 'max_leases', fallback=0))
+    # Raw API responses are kept for replay.py when capture_directory is set
+    capture = None
+    capture_directory = Config.get('global', 'capture_directory', fallback='')
+    if capture_directory:
+        capture = CaptureWriter(capture_directory,
+                                Config.getint('global', 'capture_segment_size', fallback=64 * 1024 * 1024))
+    # Files of all boards are stored once by md5 when file_store is set
+    file_store = None
+    if Config.get('global', 'file_store', fallback=''):
+        file_store = FileStore(Config.get('global', 'file_store'), db_client[db_prefix]['files'],
+                               links=Config.getboolean('global', 'file_store_links', fallback=True))
+    try:
+        while Config.getboolean('global', 'loop', fallback=True):
+            schedule = scheduler.next_board()
+            wait_time = int(schedule.next_time - time())
+            if wait_time > 0:
+                stopwatch_countdown(wait_time, 'Waiting {0} seconds for /{1}/.'.format(wait_time, schedule.name))
+            if lease_manager and not lease_manager.acquire(schedule.name):
+                logging.debug('/{0}/ is leased by another worker'.format(schedule.name))
+                scheduler.postpone(schedule)
+                continue
+            run_schedule(scheduler, schedule, client, capture, file_store)
+            if lease_manager:
+                lease_manager.release(schedule.name, schedule.next_time)
+            Config.read('config.conf')
+    finally:
+        if lease_manager:
+            lease_manager.release_all()
+        if capture:
+            capture.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import time
+from pymongo import monitoring
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Label name of labelled metrics, other metrics have the single 'all' label
+METRIC_LABELS = {'http_responses': 'code',
+                 'http_request_seconds': 'host',
+                 'mongodb_commands': 'command',
+                 'mongodb_command_seconds': 'command',
+                 'mongodb_failed_commands': 'command'}
+
+
+class Metrics:
+    # Per cycle counters, latency histograms and stage timings, shared by all threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycles = {}
+        self.start_time = time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time()
+            self.stages = {}
+            self.counters = {}
+            self.histograms = {}
+
+    def add(self, name, value=1, label='all'):
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[label] = counter.get(label, 0) + value
+
+    def observe(self, name, seconds, label='all'):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).setdefault(
+                label, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0, 'count': 0})
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + time() - start_time
+
+    def get_cycle_doc(self, board_name):
+        with self.lock:
+            cycle_time = time() - self.start_time
+            counters = {name: dict(counter) for name, counter in self.counters.items()}
+            rates = {name: counters[name]['all'] / max(cycle_time, 1)
+                     for name in ('new_posts', 'new_threads', 'downloaded_bytes') if name in counters}
+            return {'board': board_name,
+                    'date': int(time()),
+                    'cycle_seconds': cycle_time,
+                    'stages': dict(self.stages),
+                    'counters': counters,
+                    'rates': rates,
+                    'histograms': {name: {label: dict(histogram, buckets=list(histogram['buckets']))
+                                          for label, histogram in labels.items()}
+                                   for name, labels in self.histograms.items()}}
+
+    def finish_cycle(self, board_name, stats_link, metrics_file):
+        cycle_doc = self.get_cycle_doc(board_name)
+        self.cycles[board_name] = cycle_doc
+        stats_link.insert_one(dict(cycle_doc))
+        if metrics_file:
+            self.write_prometheus(metrics_file)
+        logging.info('Stage times : {0}'.format(', '.join('{0} {1:.1f}s'.format(stage, seconds)
+                                                          for stage, seconds in cycle_doc['stages'].items())))
+
+    def write_prometheus(self, metrics_file):
+        # Last cycle of every board in Prometheus text format, replaced atomically
+        families = {}
+
+        def add_sample(family, metric_type, labels, value, suffix=''):
+            samples = families.setdefault(family, (metric_type, []))[1]
+            label_string = ','.join('{0}="{1}"'.format(key, str(label).replace('"', '\\"'))
+                                    for key, label in labels)
+            samples.append('boardparser_{0}{1}{{{2}}} {3}'.format(family, suffix, label_string, value))
+
+        for board_name, cycle_doc in sorted(self.cycles.items()):
+            board_label = ('board', board_name)
+            add_sample('cycle_seconds', 'gauge', [board_label], cycle_doc['cycle_seconds'])
+            add_sample('cycle_timestamp_seconds', 'gauge', [board_label], cycle_doc['date'])
+            for stage, seconds in sorted(cycle_doc['stages'].items()):
+                add_sample('stage_seconds', 'gauge', [board_label, ('stage', stage)], seconds)
+            for name, rate in sorted(cycle_doc['rates'].items()):
+                add_sample('{0}_per_second'.format(name), 'gauge', [board_label], rate)
+            for name, counter in sorted(cycle_doc['counters'].items()):
+                for label, value in sorted(counter.items()):
+                    labels = [board_label] if label == 'all' else [board_label, (METRIC_LABELS[name], label)]
+                    add_sample(name, 'gauge', labels, value)
+            for name, histograms in sorted(cycle_doc['histograms'].items()):
+                for label, histogram in sorted(histograms.items()):
+                    labels = [board_label] if label == 'all' else [board_label, (METRIC_LABELS[name], label)]
+                    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                        add_sample(name, 'histogram', labels + [('le', bound)], count, '_bucket')
+                    add_sample(name, 'histogram', labels + [('le', '+Inf')], histogram['count'], '_bucket')
+                    add_sample(name, 'histogram', labels, histogram['sum'], '_sum')
+                    add_sample(name, 'histogram', labels, histogram['count'], '_count')
+        lines = []
+        for family, (metric_type, samples) in families.items():
+            lines.append('# TYPE boardparser_{0} {1}'.format(family, metric_type))
+            lines.extend(samples)
+        directory_name = os.path.dirname(metrics_file)
+        if directory_name and not os.path.exists(directory_name):
+            os.makedirs(directory_name)
+        with open(metrics_file + '.tmp', 'w') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(metrics_file + '.tmp', metrics_file)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.add('mongodb_commands', label=event.command_name)
+        metrics.observe('mongodb_command_seconds', event.duration_micros / 1000000, label=event.command_name)
+
+    def failed(self, event):
+        metrics.add('mongodb_failed_commands', label=event.command_name)
+
+
+def observe_response(response, *args, **kwargs):
+    # requests response hook
+    metrics.add('http_responses', label=str(response.status_code))
+    metrics.observe('http_request_seconds', response.elapsed.total_seconds(),
+                    label=response.url.split('/')[2] if '://' in response.url else 'all')
+
+
+metrics = Metrics()
@@ -2,11 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import re
+import sys
 from configparser import ConfigParser
-from time import time, clock, sleep, strftime, gmtime
+from time import time, sleep, strftime, gmtime
 from shutil import get_terminal_size
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from requests import Session
+from requests.adapters import HTTPAdapter
+from html import unescape
 from html.parser import HTMLParser
+from client import HttpClient, TokenBucket
+from metrics import MongoCommandListener, observe_response
 
 
 def init_config(file):
@@ -15,6 +23,19 @@ def init_config(file):
     if 'global' not in config.sections():
         config['global'] = {'loop': 1,
                             'wait_timeout': 1000,
+                            'min_wait_timeout': 60,
+                            'target_new_posts': 100,
+                            'boards': 'b',
+                            'shards': 1,
+                            'leases': 0,
+                            'lease_timeout': 1800,
+                            'max_leases': 0,
+                            'metrics_file': 'log/metrics.prom',
+                            'capture_directory': '',
+                            'capture_segment_size': 67108864,
+                            'word_index': 0,
+                            'file_store': 'files/store',
+                            'file_store_links': 1,
                             'wait_timeout_fallback': 60,
                             'log_file_prefix': 'boardparser',
                             'log_file_level': 'debug',
@@ -22,6 +43,16 @@ def init_config(file):
                             'mongodb_host': '127.0.0.1',
                             'mongodb_port': 27017,
                             'database_prefix': 'boardparser',
+                            'fetch_workers': 8,
+                            'requests_per_second': 10,
+                            'requests_burst': 1,
+                            'request_timeout': 5,
+                            'request_retries': 3,
+                            'host_connections': 0,
+                            'incremental_polling': 1,
+                            'download_workers': 4,
+                            'pipeline': 0,
+                            'pipeline_queue_size': 64,
                             'http_proxy': '',
                             'https_proxy': ''}
         with open('config.conf', 'w') as configfile:
@@ -66,7 +97,94 @@ def init_logger(config):
 
 def init_dbclient(config):
     return MongoClient(config.get('global', 'mongodb_host', fallback='127.0.0.1'),
-                       config.getint('global', 'mongodb_port', fallback=27017))
+                       config.getint('global', 'mongodb_port', fallback=27017),
+                       event_listeners=[MongoCommandListener()])
+
+
+def init_requests_session(config):
+    # One pooled session shared by all fetch and download workers, which run together in pipeline mode
+    pool_size = config.getint('global', 'fetch_workers', fallback=8) + \
+        config.getint('global', 'download_workers', fallback=4)
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(observe_response)
+    return session
+
+
+def init_http_client(config):
+    rate = config.getfloat('global', 'requests_per_second', fallback=10)
+    return HttpClient(init_requests_session(config),
+                      TokenBucket(rate, config.getint('global', 'requests_burst', fallback=1)),
+                      timeout=config.getfloat('global', 'request_timeout', fallback=5),
+                      retries=config.getint('global', 'request_retries', fallback=3),
+                      host_connections=config.getint('global', 'host_connections', fallback=0))
+
+
+def ensure_unique_index(collection, key):
+    # Databases of old versions have a plain index and may have duplicates, they are migrated once
+    index_name = '{0}_1'.format(key)
+    index = collection.index_information().get(index_name)
+    if index and index.get('unique'):
+        return
+    removed_count = remove_duplicates(collection, key)
+    if index:
+        collection.drop_index(index_name)
+    collection.create_index(key, unique=True)
+    if index or removed_count:
+        logging.info('Migrated {0} to a unique {1} index, removed {2} duplicates'.format(collection.full_name, key,
+                                                                                       removed_count))
+
+
+def remove_duplicates(collection, key):
+    # Oldest document is kept, old versions read and updated the first match too
+    removed_count = 0
+    duplicates = collection.aggregate([{'$group': {'_id': '$' + key, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+                                       {'$match': {'count': {'$gt': 1}}}], allowDiskUse=True)
+    for duplicate in duplicates:
+        removed_count += collection.delete_many({'_id': {'$in': sorted(duplicate['ids'])[1:]}}).deleted_count
+    return removed_count
+
+
+def bulk_write(collection, requests, batch_size=1000):
+    # Unordered batched writes, returns summed upserted/modified/inserted/deleted counts
+    # and indexes of requests which upserted a new document
+    result = {'upserted': 0, 'modified': 0, 'inserted': 0, 'deleted': 0, 'upserted_indexes': []}
+    for i in range(0, len(requests), batch_size):
+        try:
+            details = collection.bulk_write(requests[i:i + batch_size], ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            # Concurrent writers can race on unique keys, the rest of the batch is still applied
+            details = e.details
+            logging.warning('Bulk write to {0} had {1} errors'.format(collection.full_name,
+                                                                      len(details['writeErrors'])))
+        result['upserted'] += details['nUpserted']
+        result['modified'] += details['nModified']
+        result['inserted'] += details['nInserted']
+        result['deleted'] += details['nRemoved']
+        result['upserted_indexes'].extend(i + upserted['index'] for upserted in details.get('upserted', []))
+    return result
+
+
+def deep_getsizeof(obj, seen=None):
+    # Size of an object with everything it references, shared objects are counted once
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_getsizeof(key, seen) + deep_getsizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_getsizeof(item, seen) for item in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_getsizeof(obj.__dict__, seen)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_getsizeof(getattr(obj, slot), seen)
+    return size
 
 
 # le костыль
@@ -80,7 +198,6 @@ def line_print(s):
 def stopwatch_countdown(seconds, comment=''):
     # TODO: format with mm:ss
     start = time()
-    clock()
     estimated = 1
     while estimated:
         estimated = seconds - int(time() - start)
@@ -95,10 +212,15 @@ class MLStripper(HTMLParser):
         self.strict = False
         self.convert_charrefs = True
         self.result = []
+        self.replies = []
 
     def handle_starttag(self, tag, attrs):
         if tag == 'br':
             self.result.append(' ')
+        elif tag == 'a':
+            reply = get_reply(dict(attrs))
+            if reply:
+                self.replies.append(reply)
 
     def handle_data(self, d):
         self.result.append(d)
@@ -106,3 +228,67 @@ class MLStripper(HTMLParser):
     def get_data(self):
         return ''.join(self.result)
 
+
+# Tags with plain double quoted attributes are parsed by HTMLParser exactly like this
+MESSAGE_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:\s+[a-zA-Z][-a-zA-Z0-9_]*="[^"<>]*")*)\s*/?>')
+MESSAGE_TRAILING_AMP_RE = re.compile(r'[\s;]')
+# >>post links carry the thread and the post they point to
+MESSAGE_REPLY_ATTRS_RE = re.compile(r'\s(data-thread|data-num)="([^"]*)"', re.IGNORECASE)
+# Tags that switch HTMLParser into raw text mode
+MESSAGE_RAW_TAGS = ('script', 'style', 'textarea', 'title', 'xmp', 'iframe', 'noembed', 'noframes', 'noscript',
+                    'plaintext')
+
+
+def get_reply(attrs):
+    # (thread, post) numbers of a >>post link attributes, None for other links
+    thread_number = attrs.get('data-thread') or ''
+    post_number = attrs.get('data-num') or ''
+    if thread_number.isdigit() and post_number.isdigit():
+        return int(thread_number), int(post_number)
+    return None
+
+
+def strip_message(message, replies=None):
+    # Same result as MLStripper.get_data(), anything unusual is left to MLStripper.
+    # Targets of >>post links are appended to replies list in the same pass
+    if '<' not in message and '&' not in message:
+        return message
+    result = []
+    message_replies = []
+    position = 0
+    for match in MESSAGE_TAG_RE.finditer(message):
+        text = message[position:match.start()]
+        tag = match.group(2).lower()
+        if '<' in text or tag in MESSAGE_RAW_TAGS:
+            return strip_message_slow(message, replies)
+        if text:
+            result.append(unescape(text))
+        if not match.group(1):
+            if tag == 'br':
+                result.append(' ')
+            elif tag == 'a' and replies is not None:
+                reply = get_reply({name.lower(): unescape(value)
+                                   for name, value in MESSAGE_REPLY_ATTRS_RE.findall(match.group(3))})
+                if reply:
+                    message_replies.append(reply)
+        position = match.end()
+    text = message[position:]
+    if '<' in text:
+        return strip_message_slow(message, replies)
+    # MLStripper is never closed, so it keeps back trailing text which may end with a cut charref
+    amp_position = text.rfind('&', max(0, len(text) - 34))
+    if amp_position >= 0 and not MESSAGE_TRAILING_AMP_RE.search(text, amp_position):
+        return strip_message_slow(message, replies)
+    if text:
+        result.append(unescape(text))
+    if replies is not None:
+        replies.extend(message_replies)
+    return ''.join(result)
+
+
+def strip_message_slow(message, replies=None):
+    s = MLStripper()
+    s.feed(message)
+    if replies is not None:
+        replies.extend(s.replies)
+    return s.get_data()
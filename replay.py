@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import json
+import logging
+from time import time
+from capture import CaptureReader
+from misc import line_print, init_config, init_logger, init_dbclient
+from sosach import SosachBoard, Thread
+from wordindex import WordIndex
+
+__version__ = '0.1'
+
+Config = init_config('config.conf')
+Config.set('global', 'log_file_prefix', 'replay')
+init_logger(Config)
+
+db_client = init_dbclient(Config)
+db_prefix = Config.get('global', 'database_prefix', fallback='boardparser')
+
+
+def get_thread_entry(thread_number, threads_entries, posts):
+    # threads.json entry of the thread, made up from its OP post if it was not captured
+    if thread_number in threads_entries:
+        return threads_entries[thread_number]
+    op_post = posts[0] if posts else {}
+    return {'num': thread_number,
+            'subject': op_post.get('subject', ''),
+            'timestamp': op_post.get('timestamp', 0),
+            'views': 0}
+
+
+def replay_board(board_name, args):
+    start_time = time()
+    board = SosachBoard(board_name, None, db_client, args.database_prefix)
+    if Config.getboolean('global', 'word_index', fallback=False):
+        board.word_index = WordIndex(board.db_link)
+    board.ensure_indexes()
+    reader = CaptureReader(args.capture_directory)
+    threads_entries = {}
+    unique_posters = {}
+    batch = []
+    counters = {'records': 0, 'new_threads': 0, 'new_posts': 0}
+
+    def save_batch():
+        if not batch:
+            return
+        new_threads, updated_threads, new_posts = board.save_threads(batch, save_state=False,
+                                                                     update_threads=not args.backfill)
+        counters['new_threads'] += new_threads
+        counters['new_posts'] += new_posts
+        del batch[:]
+        line_print(' [{0}] Replayed records, {1} new threads and {2} new posts'.format(
+            counters['records'], counters['new_threads'], counters['new_posts']))
+
+    for record in reader.read(board_name, args.thread, args.since, args.until):
+        counters['records'] += 1
+        try:
+            parsed_response = json.loads(record['body'])
+        except ValueError:
+            logging.warning('Captured {0} is not valid JSON'.format(record['url']))
+            continue
+        if record['kind'] == 'threads':
+            threads_entries = {int(parsed_thread['num']): parsed_thread
+                               for parsed_thread in parsed_response['threads']}
+            # Rebuilding a database also moves threads to dead collections as the crawler did
+            if not args.backfill and not args.thread:
+                save_batch()
+                board.threads_json = parsed_response['threads']
+                board.separate_dead_threads()
+            continue
+        if record['kind'] == 'thread':
+            posts = parsed_response['threads'][0]['posts']
+        elif isinstance(parsed_response, list):
+            # First post of new posts responses was stored before
+            posts = parsed_response[1:]
+        else:
+            continue
+        th = Thread(board_name, None, get_thread_entry(record['thread'], threads_entries, posts))
+        if record['kind'] == 'thread':
+            th.load_thread_json(parsed_response)
+            unique_posters[th.number] = th.unique_posters
+        else:
+            th.posts_json = posts
+            th.unique_posters = unique_posters.get(th.number, 0)
+        th.parse_posts()
+        batch.append(th)
+        if len(batch) >= args.batch_size:
+            save_batch()
+    save_batch()
+    line_print('')
+    logging.info('Replayed {0} records of /{1}/ in {2} seconds'.format(counters['records'], board_name,
+                                                                      int(time() - start_time)))
+    logging.info('Saved {0} new threads and {1} new posts to {2}'.format(counters['new_threads'],
+                                                                         counters['new_posts'],
+                                                                         board.db_link.name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured API responses into MongoDB')
+    parser.add_argument('boards', nargs='+')
+    parser.add_argument('--capture-directory', default=Config.get('global', 'capture_directory', fallback='capture'))
+    parser.add_argument('--database-prefix', default=db_prefix + '_replay',
+                        help='prefix of databases to rebuild, defaults to a separate <prefix>_replay')
+    parser.add_argument('--backfill', action='store_true',
+                        help='only insert missing threads and posts, for replaying into the live databases')
+    parser.add_argument('--thread', type=int, help='replay only this thread')
+    parser.add_argument('--since', type=float, help='unix time of the first record')
+    parser.add_argument('--until', type=float, help='unix time of the last record')
+    parser.add_argument('--batch-size', type=int, default=64, help='threads saved at once')
+    args = parser.parse_args()
+    if args.database_prefix == db_prefix and not args.backfill:
+        parser.error('replaying into the live databases needs --backfill')
+    for board_name in args.boards:
+        replay_board(board_name, args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        line_print('=== User exit ===')
+        exit()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+from time import time
+
+
+class BoardSchedule:
+    # Weight of the last cycle in the smoothed post rate
+    rate_smoothing = 0.5
+
+    def __init__(self, board, shard, shards, min_interval, max_interval):
+        self.board = board
+        self.shard = shard
+        self.shards = shards
+        self.name = board if shards == 1 else '{0}:{1}/{2}'.format(board, shard, shards)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = max_interval
+        self.next_time = 0
+        self.last_start_time = None
+        self.post_rate = None
+
+    def update(self, start_time, new_posts, target_posts):
+        # Polls a board often enough to get about target_posts new posts per cycle
+        if self.last_start_time:
+            rate = new_posts / max(1, start_time - self.last_start_time)
+            if self.post_rate is None:
+                self.post_rate = rate
+            else:
+                self.post_rate = self.rate_smoothing * rate + (1 - self.rate_smoothing) * self.post_rate
+        self.last_start_time = start_time
+        if self.post_rate:
+            self.interval = min(self.max_interval, max(self.min_interval, target_posts / self.post_rate))
+        else:
+            self.interval = self.max_interval
+        self.next_time = start_time + self.interval
+
+
+class Scheduler:
+    def __init__(self, boards, min_interval, max_interval, target_posts, fallback_interval, shards=1):
+        # Every board is split into shards by thread number, each shard is scheduled on its own
+        self.schedules = [BoardSchedule(name, shard, shards, min_interval, max_interval)
+                          for name in boards for shard in range(shards)]
+        self.target_posts = target_posts
+        self.fallback_interval = fallback_interval
+
+    def next_board(self):
+        return min(self.schedules, key=lambda schedule: schedule.next_time)
+
+    def update(self, schedule, start_time, new_posts):
+        schedule.update(start_time, new_posts, self.target_posts)
+        if schedule.next_time < time():
+            logging.warning('Writing /{0}/ board time is longer than its {1} seconds interval'.format(
+                schedule.name, int(schedule.interval)))
+            schedule.next_time = time() + self.fallback_interval
+        logging.info('Next /{0}/ poll in {1} seconds ({2:.2f} posts per second)'.format(
+            schedule.name, int(schedule.next_time - time()), schedule.post_rate or 0))
+
+    def postpone(self, schedule):
+        schedule.next_time = time() + self.fallback_interval
@@ -3,11 +3,20 @@
 
 import logging
 import os
-from time import time, sleep
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Empty
+from time import time
 from datetime import datetime
-from misc import line_print, MLStripper
+from requests import RequestException
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from downloader import FileDownloader
+from misc import line_print, bulk_write, deep_getsizeof, ensure_unique_index, strip_message
 
 Proxies = {}
+# Changed by benchmark.py to point the crawler to a local server
+API_URL = 'https://2ch.hk'
 
 # File types
 FILE_JPEG = 1
@@ -17,201 +26,567 @@ FILE_STICKER = 100
 
 
 class Board:
-    api_request_timeout = 5
-    api_wait_timeout = 0
-
     def __init__(self, name):
         self.name = name
 
 
 class SosachBoard(Board):
-    def __init__(self, name, requests_session, db_client, db_prefix):
+    # Cycles a failed file is tried in before it is dropped from pending_files
+    max_file_attempts = 5
+
+    def __init__(self, name, client, db_client, db_prefix):
         super(Board, self).__init__()
         self.name = name
-        self.requests_session = requests_session
+        # HttpClient shared by boards, it keeps all of them within one request budget
+        self.client = client
         self.db_link = db_client[db_prefix + '_' + name]
         self.proxy = {}
-        self.threads_api_url = 'https://2ch.hk/{0}/threads.json'.format(name)
+        self.threads_api_url = '{0}/{1}/threads.json'.format(API_URL, name)
         self.threads_json = None
         self.threads = []
+        self.unchanged_threads = 0
+        self.new_threads = 0
+        self.new_posts = 0
+        # Index and count of shards, only threads with number % count == index are processed
+        self.shard = (0, 1)
+        # CaptureWriter keeping raw API responses
+        self.capture = None
+        # WordIndex updated with newly saved posts
+        self.word_index = None
+        # FileStore shared by boards, files are kept in files/<board> without it
+        self.file_store = None
+        # Set to compare memory of raw JSON posts against parsed Post objects
+        self.measure_memory = False
+        self.memory_stats = {'posts': 0, 'raw': 0, 'parsed': 0}
+        self.memory_stats_lock = threading.Lock()
 
     def update_live_threads(self):
         logging.info('Requesting /{0}/ board threads'.format(self.name))
-        response = self.requests_session.get(self.threads_api_url, proxies=Proxies, timeout=self.api_request_timeout)
+        try:
+            response = self.client.get(self.threads_api_url, proxies=Proxies)
+        except RequestException as e:
+            logging.error('Requesting /{0}/ threads failed : {1}'.format(self.name, e))
+            return False
         if response.status_code != 200:
             logging.error('Requesting /{0}/ threads failed. HTTP status code is {1}'.format(self.name,
                                                                                             response.status_code))
             return False
+        if self.capture:
+            self.capture.write(self.name, 'threads', None, self.threads_api_url, response.text)
         try:
             self.threads_json = response.json()['threads']
             logging.info('Fetched {0} threads'.format(len(self.threads_json)))
         except ValueError:
             logging.error('Parsing JSON for threads on {0} failed'.format(self.name))
             return False
+        return True
 
-    def parse_live_threads(self):
-        for parsed_thread in self.threads_json:
-            th = Thread(self.name, self.requests_session, parsed_thread)
-            out_string = ' [{0}/{1}] Requesting #{2} thread on /{3}/'.format(self.threads_json.index(parsed_thread) + 1,
-                                                                             len(self.threads_json),
-                                                                             th.number,
-                                                                             th.board_name)
-            logging.debug(out_string)
-            line_print(out_string)
-            th.update_posts()
-            try:
-                for parsed_post in th.posts_json:
-                    p = Post(parsed_post)
-                    th.posts.append(p)
-                self.threads.append(th)
-            except TypeError:
-                logging.warning('Parsing thread #{0} failed'.format(th.number))
-            sleep(self.api_wait_timeout)
-
-    def save_live_threads(self):
-        logging.info('Saving {0} threads'.format(len(self.threads)))
+    def load_threads_state(self):
+        numbers = [int(parsed_thread['num']) for parsed_thread in self.threads_json]
+        return {state['number']: state for state in self.db_link['threads_state'].find({'number': {'$in': numbers}})}
+
+    def save_threads_state(self, threads):
+        state_link = self.db_link['threads_state']
+        bulk_write(state_link, [ReplaceOne({'number': thread.number}, thread.get_state_doc(), upsert=True)
+                                for thread in threads])
+
+    def ensure_indexes(self):
+        for collection in ('threads', 'posts', 'dead_threads', 'dead_posts', 'threads_state'):
+            ensure_unique_index(self.db_link[collection], 'number')
+        ensure_unique_index(self.db_link['files'], 'md5')
+        self.db_link['posts'].create_index('thread')
+        self.db_link['dead_posts'].create_index('thread')
+        for collection in ('posts', 'dead_posts'):
+            self.db_link[collection].create_index('replies_to')
+            self.db_link[collection].create_index('replies', sparse=True)
+        for collection in ('threads', 'dead_threads'):
+            self.db_link[collection].create_index('replies', sparse=True)
+        if self.word_index:
+            self.word_index.ensure_indexes()
+
+    def get_live_threads(self, incremental=True):
+        if self.threads_json is None:
+            return []
+        states = self.load_threads_state() if incremental else {}
+        shard, shards = self.shard
+        return [Thread(self.name, self.client, parsed_thread, states.get(int(parsed_thread['num'])),
+                       self.capture)
+                for parsed_thread in self.threads_json if int(parsed_thread['num']) % shards == shard]
+
+    def fetch_thread(self, th):
+        # Unchanged threads are kept for views updates and dead threads separation
+        if not th.changed:
+            return th
+        try:
+            if not th.update_posts():
+                return None
+            if self.measure_memory:
+                raw_size = deep_getsizeof(th.posts_json)
+            th.parse_posts()
+            if self.measure_memory:
+                with self.memory_stats_lock:
+                    self.memory_stats['posts'] += len(th.posts)
+                    self.memory_stats['raw'] += raw_size
+                    self.memory_stats['parsed'] += deep_getsizeof(th.posts)
+        except (KeyError, TypeError, ValueError):
+            logging.warning('Parsing thread #{0} failed'.format(th.number))
+            return None
+        except RequestException as e:
+            logging.error('Requesting #{0} thread failed : {1}'.format(th.number, e))
+            return None
+        return th
+
+    def log_memory_stats(self):
+        if not self.measure_memory or not self.memory_stats['posts']:
+            return
+        posts = self.memory_stats['posts']
+        logging.info('Memory per post is {0} bytes as JSON and {1} bytes parsed ({2} posts measured)'.format(
+            self.memory_stats['raw'] // posts, self.memory_stats['parsed'] // posts, posts))
+
+    def parse_live_threads(self, workers=1, incremental=True):
         start_time = time()
-        new_threads = 0
-        new_posts = 0
+        progress = {'done': 0, 'lock': threading.Lock()}
+        threads = self.get_live_threads(incremental)
+        changed_threads = [th for th in threads if th.changed]
+        self.unchanged_threads = len(threads) - len(changed_threads)
+
+        def fetch_thread(th):
+            result = self.fetch_thread(th)
+            if th.changed:
+                with progress['lock']:
+                    progress['done'] += 1
+                    out_string = ' [{0}/{1}] Requested #{2} thread on /{3}/'.format(progress['done'],
+                                                                                   len(changed_threads),
+                                                                                   th.number,
+                                                                                   th.board_name)
+                    logging.debug(out_string)
+                    line_print(out_string)
+            return result
+
+        # map() keeps results in threads.json order regardless of completion order
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for th in executor.map(fetch_thread, threads):
+                if th:
+                    self.threads.append(th)
+        line_print('')
+        logging.info('Fetched {0}/{1} threads with {2} new posts using {3} workers in {4} seconds'.format(
+            len(self.threads), len(threads), sum(len(th.posts) for th in self.threads), max(1, workers),
+            int(time() - start_time)))
+        logging.info('Skipped {0} unchanged threads, requested {1} changed threads'.format(self.unchanged_threads,
+                                                                                          len(changed_threads)))
+        self.log_memory_stats()
+
+    def process_live_threads(self, file_type, workers=1, download_workers=4, incremental=True, queue_size=64,
+                             save_batch_size=16):
+        # Streaming fetch -> save -> download pipeline, board.threads is left empty
+        start_time = time()
+        self.ensure_indexes()
+        threads_queue = Queue()
+        for th in self.get_live_threads(incremental):
+            threads_queue.put(th)
+        parsed_queue = Queue(queue_size)
+        files_queue = Queue(queue_size)
+        downloader = FileDownloader(self.client.session, 'files/{0}'.format(self.name))
+        counters = {'fetched': 0, 'unchanged': 0, 'new_threads': 0, 'updated_threads': 0, 'new_posts': 0,
+                    'files': 0, 'new_files': 0, 'downloaded_files': 0}
+        counters_lock = threading.Lock()
+        total_threads = threads_queue.qsize()
+
+        def fetch_stage():
+            while True:
+                try:
+                    th = threads_queue.get_nowait()
+                except Empty:
+                    return
+                th = self.fetch_thread(th)
+                if th:
+                    parsed_queue.put(th)
+
+        def save_batch(batch):
+            new_threads, updated_threads, new_posts = self.save_threads(batch, file_type=file_type)
+            download_list = self.get_download_list([post for th in batch for post in th.posts], file_type)
+            new_files = self.get_new_files(download_list, queued_md5)
+            with counters_lock:
+                counters['fetched'] += sum(1 for th in batch if th.changed)
+                counters['unchanged'] += sum(1 for th in batch if not th.changed)
+                counters['new_threads'] += new_threads
+                counters['updated_threads'] += updated_threads
+                counters['new_posts'] += new_posts
+                counters['files'] += len(download_list)
+                counters['new_files'] += len(new_files)
+            for file in new_files:
+                files_queue.put(file)
+            line_print(' [{0}/{1}] Saved threads, {2} new posts, {3}/{4} files downloaded'.format(
+                counters['fetched'] + counters['unchanged'], total_threads, counters['new_posts'],
+                counters['downloaded_files'], counters['new_files']))
+
+        def save_stage():
+            batch = []
+            while True:
+                th = parsed_queue.get()
+                if th is not None:
+                    batch.append(th)
+                if batch and (th is None or len(batch) >= save_batch_size or parsed_queue.empty()):
+                    try:
+                        save_batch(batch)
+                    except Exception as e:
+                        logging.error('Saving threads on /{0}/ failed : {1}'.format(self.name, e))
+                    batch = []
+                if th is None:
+                    return
+
+        def download_stage():
+            while True:
+                file = files_queue.get()
+                if file is None:
+                    return
+                try:
+                    if self.finish_file(downloader, file, self.fetch_file(downloader, file)):
+                        with counters_lock:
+                            counters['downloaded_files'] += 1
+                except Exception as e:
+                    logging.error('Saving file {0} failed : {1}'.format(file['name'], e))
+
+        # Files which failed in previous cycles are downloaded again
+        pending_files = self.get_pending_files()
+        queued_md5 = set(file['md5'] for file in pending_files)
+        counters['new_files'] += len(pending_files)
+        fetchers = [threading.Thread(target=fetch_stage) for _ in range(max(1, workers))]
+        saver = threading.Thread(target=save_stage)
+        downloaders = [threading.Thread(target=download_stage) for _ in range(max(1, download_workers))]
+        for stage_thread in fetchers + [saver] + downloaders:
+            stage_thread.start()
+        for file in pending_files:
+            files_queue.put(file)
+        for stage_thread in fetchers:
+            stage_thread.join()
+        parsed_queue.put(None)
+        saver.join()
+        for _ in downloaders:
+            files_queue.put(None)
+        for stage_thread in downloaders:
+            stage_thread.join()
+        line_print('')
+        self.unchanged_threads = counters['unchanged']
+        self.new_threads += counters['new_threads']
+        self.new_posts += counters['new_posts']
+        logging.info('Processed {0} threads in {1} seconds'.format(total_threads, int(time() - start_time)))
+        logging.info('Skipped {0} unchanged threads, requested {1} changed threads'.format(counters['unchanged'],
+                                                                                          counters['fetched']))
+        logging.info('Saved {0} new threads, updated {1} threads and saved {2} new posts'.format(
+            counters['new_threads'], counters['updated_threads'], counters['new_posts']))
+        logging.info('Downloaded {0}/{1} files, {2} were already stored'.format(
+            counters['downloaded_files'], counters['files'], counters['files'] - counters['new_files']))
+        self.log_memory_stats()
+
+    def save_threads(self, threads, save_state=True, update_threads=True, file_type=None):
+        # Returns new threads, updated threads and new posts counts.
+        # Files of file_type in new posts are queued for downloading before the polling state moves past them
         th_link = self.db_link['threads']
         p_link = self.db_link['posts']
-        th_link.create_index('number')
-        p_link.create_index('number')
-
-        for thread in self.threads:
-            db_result = th_link.find_one({'number': thread.number})
-            if not db_result:
-                out_string = ' [{0}/{1}] Saving new thread #{2} : '.format(self.threads.index(thread) + 1,
-                                                                           len(self.threads),
-                                                                           thread.number)
-                logging.debug(out_string)
-                line_print(out_string)
-                th_link.insert_one(thread.get_db_doc())
-                new_threads += 1
-            elif db_result['views'] == thread.views and db_result['unique_posters'] == thread.unique_posters:
-                out_string = ' [{0}/{1}] Thread #{2} not changed : '.format(self.threads.index(thread) + 1,
-                                                                            len(self.threads),
-                                                                            thread.number)
-                logging.debug(out_string)
-                line_print(out_string)
+        thread_requests = []
+        post_requests = []
+        posts = []
+        for thread in threads:
+            thread_doc = thread.get_db_doc()
+            thread_update = {'views': thread_doc.pop('views'), 'unique_posters': thread_doc.pop('unique_posters')}
+            # Same views and unique posters do not count as modified, as before
+            if update_threads:
+                thread_update = {'$set': thread_update, '$setOnInsert': thread_doc}
             else:
-                out_string = ' [{0}/{1}] Updating thread #{2} : '.format(self.threads.index(thread) + 1,
-                                                                         len(self.threads),
-                                                                         thread.number)
-                logging.debug(out_string)
-                line_print(out_string)
-                th_link.update_one({'number': thread.number},
-                                   {'$set': {'views': thread.views, 'unique_posters': thread.unique_posters}})
+                thread_doc.update(thread_update)
+                thread_update = {'$setOnInsert': thread_doc}
+            thread_requests.append(UpdateOne({'number': thread.number}, thread_update, upsert=True))
             for post in thread.posts:
-                if not p_link.find_one({'number': post.number}):
-                    post_out_string = ' [{0}/{1}] Saving post #{2}'.format(thread.posts.index(post) + 1,
-                                                                           len(thread.posts),
-                                                                           post.number)
-                    logging.debug(out_string + post_out_string)
-                    line_print(out_string + post_out_string)
-                    p_link.insert_one(post.get_db_doc())
-                    new_posts += 1
-                else:
-                    post_out_string = ' [{0}/{1}] Passing post #{2}'.format(thread.posts.index(post) + 1,
-                                                                            len(thread.posts),
-                                                                            post.number)
-                    logging.debug(out_string + post_out_string)
-                    line_print(out_string + post_out_string)
-        line_print('')
+                post_requests.append(UpdateOne({'number': post.number}, {'$setOnInsert': post.get_db_doc()},
+                                               upsert=True))
+                posts.append(post)
+        threads_result = bulk_write(th_link, thread_requests)
+        posts_result = bulk_write(p_link, post_requests)
+        new_posts = [posts[index] for index in posts_result['upserted_indexes']]
+        self.save_replies(new_posts)
+        if self.word_index:
+            self.word_index.add_posts(new_posts)
+        if file_type:
+            self.queue_files(self.get_download_list(new_posts, file_type))
+        # Polling state goes last so a crash never marks unsaved posts as seen
+        if save_state:
+            self.save_threads_state(threads)
+        return threads_result['upserted'], threads_result['modified'], posts_result['upserted']
+
+    def save_replies(self, posts):
+        # Reply counts grow only by posts saved for the first time, so every reply is counted once.
+        # Targets may be already separated, so dead collections are updated as well
+        post_replies = {}
+        thread_replies = {}
+        for post in posts:
+            for thread_number, post_number in post.replies:
+                post_replies[post_number] = post_replies.get(post_number, 0) + 1
+                thread_replies[thread_number] = thread_replies.get(thread_number, 0) + 1
+        for collections, replies in ((('posts', 'dead_posts'), post_replies),
+                                     (('threads', 'dead_threads'), thread_replies)):
+            requests = [UpdateOne({'number': number}, {'$inc': {'replies': count}})
+                        for number, count in replies.items()]
+            for collection in collections:
+                bulk_write(self.db_link[collection], requests)
+
+    def get_most_replied(self, collection, limit=20):
+        # Most replied posts or threads, live and dead ones
+        most_replied = []
+        for name in (collection, 'dead_' + collection):
+            most_replied.extend(self.db_link[name].find({'replies': {'$exists': True}}, {'_id': 0})
+                                .sort('replies', -1).limit(limit))
+        return sorted(most_replied, key=lambda doc: doc['replies'], reverse=True)[:limit]
+
+    def get_replies(self, post_number):
+        # Posts replying to the post, oldest first
+        replies = []
+        for name in ('posts', 'dead_posts'):
+            replies.extend(self.db_link[name].find({'replies_to': post_number}, {'_id': 0}))
+        return sorted(replies, key=lambda doc: doc['number'])
+
+    def save_live_threads(self, file_type=None):
+        logging.info('Saving {0} threads'.format(len(self.threads)))
+        start_time = time()
+        th_link = self.db_link['threads']
+        p_link = self.db_link['posts']
+        self.ensure_indexes()
+        new_threads, updated_threads, new_posts = self.save_threads(self.threads, file_type=file_type)
+        self.new_threads += new_threads
+        self.new_posts += new_posts
         logging.info('Written {0} threads in {1} seconds'.format(len(self.threads), int(time() - start_time)))
-        logging.info('Saved {0} new threads and {1} new posts'.format(new_threads, new_posts))
+        logging.info('Saved {0} new threads, updated {1} threads and saved {2} new posts'.format(new_threads,
+                                                                                                updated_threads,
+                                                                                                new_posts))
         logging.info('Total saved {0} threads and {1} posts'.format(th_link.count(), p_link.count()))
-        stats = {'new_posts': ''}
+
+    def separate_dead_thread(self, db_thread):
+        # Copies are idempotent upserts and every delete follows its copy, so an interrupted move is just redone
+        p_link = self.db_link['posts']
+        p_d_link = self.db_link['dead_posts']
+        number = db_thread['number']
+        db_posts = list(p_link.find({'thread': number}, {'_id': 0}))
+        if db_posts:
+            bulk_write(p_d_link, [ReplaceOne({'number': db_post['number']}, db_post, upsert=True)
+                                  for db_post in db_posts])
+            p_link.delete_many({'thread': number, 'number': {'$in': [db_post['number'] for db_post in db_posts]}})
+        del (db_thread['_id'])
+        self.db_link['dead_threads'].replace_one({'number': number}, db_thread, upsert=True)
+        self.db_link['threads'].delete_one({'number': number})
+        self.db_link['threads_state'].delete_one({'number': number})
+        logging.debug('Thread #{0} is dead and separated with {1} posts'.format(number, len(db_posts)))
+        return len(db_posts)
 
     def separate_dead_threads(self):
         start_time = time()
         threads_count = 0
         posts_count = 0
         logging.info('Separating dead threads in /{0}/'.format(self.name))
+        if not self.threads_json:
+            logging.warning('Live threads of /{0}/ are unknown, dead threads are not separated'.format(self.name))
+            return
         th_link = self.db_link['threads']
-        p_link = self.db_link['posts']
         th_d_link = self.db_link['dead_threads']
         p_d_link = self.db_link['dead_posts']
-        db_threads = th_link.find()
-        live_threads_numbers = []
-        for thread in self.threads:
-            live_threads_numbers.append(thread.number)
-        for db_thread in db_threads:
-            if db_thread['number'] not in live_threads_numbers:
-                del (db_thread['_id'])
-                th_d_link.insert_one(db_thread)
-                th_link.delete_one({'number': db_thread['number']})
-                threads_count += 1
-                db_posts = p_link.find({'thread': db_thread['number']})
-                for db_post in db_posts:
-                    del (db_post['_id'])
-                    p_d_link.insert_one(db_post)
-                    p_link.delete_one({'number': db_post['number']})
-                    posts_count += 1
-                    logging.debug('Post #{0} is dead and separated'.format(db_post['number']))
-                logging.debug('Thread #{0} is dead and separated'.format(db_thread['number']))
+        self.ensure_indexes()
+        # Every thread listed in threads.json is alive, even if requesting it failed in this cycle
+        live_threads_numbers = [int(parsed_thread['num']) for parsed_thread in self.threads_json]
+        number_query = {'$nin': live_threads_numbers}
+        # Each shard separates only its own threads, other shards may save theirs after this threads.json
+        shard, shards = self.shard
+        if shards > 1:
+            number_query['$mod'] = [shards, shard]
+        for db_thread in th_link.find({'number': number_query}):
+            posts_count += self.separate_dead_thread(db_thread)
+            threads_count += 1
         logging.info('Separated {0} dead threads with {1} posts in {2} seconds'
                      .format(threads_count, posts_count, int(time() - start_time)))
         logging.info('Total stored {0} dead threads and {1} dead posts'.format(th_d_link.count(), p_d_link.count()))
 
-    def download_files(self, file_type):
-        start_time = time()
-        files_count = 0
+    def get_download_list(self, posts, file_type):
         download_list = []
-        files_db_link = self.db_link['files']
-
-        logging.info('Downloading files')
-        for thread in self.threads:
-            for post in thread.posts:
-                for file in post.files:
-                    if file['type'] == file_type:
-                        download_list.append({
-                            'url': 'https://2ch.hk{0}'.format(file['path']),
-                            'name': file['name'],
-                            'md5': file['md5'],
-                        })
-
-        directory_name = 'files/{0}'.format(self.name)
-        if not os.path.exists(directory_name):
-            os.makedirs(directory_name)
+        for post in posts:
+            for file in post.files:
+                if file.type == file_type:
+                    download_list.append({
+                        'url': '{0}{1}'.format(API_URL, file.path),
+                        'name': file.name,
+                        'md5': file.md5,
+                    })
+        return download_list
 
+    def get_new_files(self, download_list, seen_md5=None):
+        # One lookup for the whole list, files already in seen_md5 or repeated in the list are skipped
+        seen_md5 = set() if seen_md5 is None else seen_md5
+        stored_md5 = set(db_file['md5'] for db_file in self.db_link['files'].find(
+            {'md5': {'$in': [file['md5'] for file in download_list]}}, {'md5': 1}))
+        new_files = []
         for file in download_list:
-            db_result = files_db_link.find_one({'md5': file['md5']})
-            if not db_result:
-                line_print(' [{0}/{1}] Downloading file'.format(download_list.index(file), len(download_list)))
-                os.system('wget -q -O {0}/{1} {2}'.format(directory_name, file['name'], file['url']))
-                db_file_doc = {'name': file['name'],
-                               'md5': file['md5'],
-                               'date': int(datetime.utcnow().timestamp())}
-                files_db_link.insert_one(db_file_doc)
-                files_count += 1
-            else:
-                line_print(' [{0}/{1}] Skipping file'.format(download_list.index(file), len(download_list)))
+            if file['md5'] not in stored_md5 and file['md5'] not in seen_md5:
+                seen_md5.add(file['md5'])
+                new_files.append(file)
+        return new_files
+
+    def queue_files(self, download_list):
+        # pending_files keeps files until they are downloaded or gone, one document per md5
+        new_files = self.get_new_files(download_list)
+        bulk_write(self.db_link['pending_files'],
+                   [UpdateOne({'_id': file['md5'] or file['name']},
+                              {'$setOnInsert': dict(file, attempts=0, date=int(time()))}, upsert=True)
+                    for file in new_files])
 
-        logging.info('Downloaded {0}/{1} files in {2} seconds'.format(
-            files_count, len(download_list), int(time() - start_time)))
+    def get_pending_files(self):
+        return [{'url': file['url'], 'name': file['name'], 'md5': file['md5']}
+                for file in self.db_link['pending_files'].find({'attempts': {'$lt': self.max_file_attempts}})
+                .sort('date', 1)]
 
+    def finish_file(self, downloader, file, result):
+        # Downloaded and gone files leave the queue, others are retried next cycle until max_file_attempts
+        pending_link = self.db_link['pending_files']
+        pending_key = {'_id': file['md5'] or file['name']}
+        if result:
+            self.save_file(file)
+            pending_link.delete_one(pending_key)
+            return True
+        if result is None:
+            pending_link.delete_one(pending_key)
+            return False
+        pending_file = pending_link.find_one_and_update(pending_key, {'$inc': {'attempts': 1}},
+                                                        return_document=ReturnDocument.AFTER)
+        if pending_file and pending_file['attempts'] >= self.max_file_attempts:
+            logging.error('Downloading {0} failed {1} times, giving up'.format(file['url'], pending_file['attempts']))
+            pending_link.delete_one(pending_key)
+            part_path = self.get_file_path(downloader, file) + '.part'
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return False
 
-        def save_stats_ntp(new_threads, new_posts):
-            self.db_link['stats']
+    def get_file_path(self, downloader, file):
+        path = self.file_store.get_file_path(file) if self.file_store else None
+        return path or os.path.join(downloader.directory_name, file['name'])
+
+    def fetch_file(self, downloader, file):
+        if self.file_store:
+            return self.file_store.fetch(downloader, file, self.name)
+        return downloader.download(file)
+
+    def save_file(self, file):
+        db_file_doc = {'name': file['name'],
+                       'md5': file['md5'],
+                       'date': int(datetime.utcnow().timestamp())}
+        if file.get('path'):
+            db_file_doc['path'] = file['path']
+        # Upsert keeps one document per md5 when several workers download the same file
+        self.db_link['files'].update_one({'md5': file['md5']}, {'$setOnInsert': db_file_doc}, upsert=True)
+
+    def download_files(self, workers=4):
+        # Downloads files queued by save_threads in this and previous cycles
+        start_time = time()
+        files_count = 0
+        ensure_unique_index(self.db_link['files'], 'md5')
+
+        logging.info('Downloading files')
+        new_files = self.get_pending_files()
+
+        downloader = FileDownloader(self.client.session, 'files/{0}'.format(self.name))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(self.fetch_file, downloader, file): file for file in new_files}
+            for index, future in enumerate(as_completed(futures)):
+                file = futures[future]
+                line_print(' [{0}/{1}] Downloaded file {2}'.format(index + 1, len(futures), file['name']))
+                if self.finish_file(downloader, file, future.result()):
+                    files_count += 1
+        line_print('')
+
+        logging.info('Downloaded {0}/{1} files in {2} seconds'.format(files_count, len(new_files),
+                                                                     int(time() - start_time)))
 
 
 class Thread:
-    def __init__(self, board_name, requests_session, thread):
+    __slots__ = ('board_name', 'client', 'number', 'subject', 'timestamp', 'unique_posters', 'views',
+                 'posts_count', 'lasthit', 'posts_api_url', 'posts_json', 'posts', 'last_post', 'last_index', 'etag',
+                 'last_modified', 'incremental_fetches', 'changed', 'capture')
+    new_posts_api_url = '{0}/makaba/mobile.fcgi?task=get_thread&board={1}&thread={2}&post={3}'
+    # New posts responses have no unique_posters, so every full_fetch_interval fetch gets the full thread
+    full_fetch_interval = 10
+
+    def __init__(self, board_name, client, thread, state=None, capture=None):
         self.board_name = board_name
-        self.requests_session = requests_session
+        self.client = client
+        self.capture = capture
         self.number = int(thread['num'])
         self.subject = thread['subject']
         self.timestamp = int(thread['timestamp'])
         self.unique_posters = 0
         self.views = int(thread['views'])
-        self.posts_api_url = 'https://2ch.hk/{0}/res/{1}.json'.format(self.board_name, self.number)
+        self.posts_count = thread.get('posts_count')
+        self.lasthit = thread.get('lasthit')
+        self.posts_api_url = '{0}/{1}/res/{2}.json'.format(API_URL, self.board_name, self.number)
         self.posts_json = None
         self.posts = []
+        # Polling state saved by the previous cycle
+        self.last_post = 0
+        self.last_index = 0
+        self.etag = None
+        self.last_modified = None
+        self.incremental_fetches = 0
+        if state:
+            self.last_post = state['last_post']
+            self.last_index = state['last_index']
+            self.unique_posters = state['unique_posters']
+            self.etag = state.get('etag')
+            self.last_modified = state.get('last_modified')
+            self.incremental_fetches = state.get('incremental_fetches', 0)
+        # Thread is fetched only if its threads.json entry differs from the previous cycle
+        self.changed = not state or self.posts_count is None or self.lasthit is None \
+            or state.get('posts_count') != self.posts_count or state.get('lasthit') != self.lasthit
 
     def update_posts(self):
-        response = self.requests_session.get(self.posts_api_url, proxies=Proxies)
+        # False when the thread could not be fetched, it is retried next cycle
+        if self.last_index and self.incremental_fetches < self.full_fetch_interval and self.update_new_posts():
+            self.incremental_fetches += 1
+            return True
+        if not self.update_all_posts():
+            return False
+        self.incremental_fetches = 0
+        return True
+
+    def update_new_posts(self):
+        # Asks only for posts starting with the last stored one, False means the full thread must be fetched
+        url = self.new_posts_api_url.format(API_URL, self.board_name, self.number, self.last_index)
+        response = self.client.get(url, proxies=Proxies)
+        if response.status_code == 200 and self.capture:
+            self.capture.write(self.board_name, 'new_posts', self.number, url, response.text)
+        if response.status_code != 200:
+            logging.debug('Requesting new posts of #{0} thread failed. HTTP code is {1}'.format(self.number,
+                                                                                               response.status_code))
+            return False
+        try:
+            parsed_response = response.json()
+        except ValueError:
+            logging.debug('Parsing JSON for new posts of #{0} thread failed'.format(self.number))
+            return False
+        # Post indexes shift when posts are deleted, so the first post must be the last stored one
+        if not isinstance(parsed_response, list) or not parsed_response \
+                or int(parsed_response[0]['num']) != self.last_post:
+            logging.debug('New posts of #{0} thread are out of sync, refetching thread'.format(self.number))
+            return False
+        self.posts_json = parsed_response[1:]
+        return True
+
+    def update_all_posts(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        response = self.client.get(self.posts_api_url, headers=headers, proxies=Proxies)
+        if response.status_code == 304:
+            self.posts_json = []
+            return True
         if response.status_code == 200:
+            if self.capture:
+                self.capture.write(self.board_name, 'thread', self.number, self.posts_api_url, response.text)
             try:
                 parsed_response = response.json()
             except ValueError:
@@ -219,12 +594,39 @@ class Thread:
                 with open('parsing_thread_{0}_failed.json'.format(self.number), 'w') as failed_json_dump:
                     failed_json_dump.write(response.text)
                     failed_json_dump.close()
-                return
-            self.posts_json = parsed_response['threads'][0]['posts']
-            self.unique_posters = int(parsed_response['unique_posters'])
-        else:
-            logging.error('Requesting #{0} thread failed. HTTP code is {1}'.format(self.number,
-                                                                                   response.status_code))
+                return False
+            self.load_thread_json(parsed_response)
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            return True
+        logging.error('Requesting #{0} thread failed. HTTP code is {1}'.format(self.number, response.status_code))
+        return False
+
+    def load_thread_json(self, parsed_response):
+        self.posts_json = [post for post in parsed_response['threads'][0]['posts']
+                           if int(post['num']) > self.last_post]
+        self.unique_posters = int(parsed_response['unique_posters'])
+
+    def parse_posts(self):
+        for parsed_post in self.posts_json:
+            self.posts.append(Post(parsed_post))
+        # Raw JSON is not needed once posts are parsed
+        self.posts_json = None
+
+    def get_state_doc(self):
+        for post in self.posts:
+            if post.number > self.last_post:
+                self.last_post = post.number
+                self.last_index = post.index
+        return {'number': self.number,
+                'last_post': self.last_post,
+                'last_index': self.last_index,
+                'unique_posters': self.unique_posters,
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'incremental_fetches': self.incremental_fetches,
+                'posts_count': self.posts_count,
+                'lasthit': self.lasthit}
 
     def get_db_doc(self):
         return {'board_name': self.board_name,
@@ -236,7 +638,15 @@ class Thread:
                 'processed': 0}
 
 
+# Target of a >>post link
+PostReply = namedtuple('PostReply', ('thread', 'number'))
+# Only these fields of API file entries are kept
+PostFile = namedtuple('PostFile', ('name', 'fullname', 'path', 'md5', 'type', 'size', 'width', 'height', 'duration'))
+
+
 class Post:
+    __slots__ = ('number', 'index', 'thread_number', 'timestamp', 'message', 'op', 'files', 'replies')
+
     def __init__(self, post):
         self.number = int(post['num'])
         self.index = int(post['number'])
@@ -248,12 +658,13 @@ class Post:
         self.message = post['comment']
         self.repair_message()
         self.op = post['op']
-        self.files = post['files']
+        self.files = tuple(PostFile(*(file.get(field) for field in PostFile._fields)) for file in post['files'])
 
     def repair_message(self):
-        s = MLStripper()
-        s.feed(self.message)
-        self.message = s.get_data()
+        # Reply links are collected while the HTML is stripped, repeated links count once
+        replies = []
+        self.message = strip_message(self.message, replies)
+        self.replies = tuple(PostReply(*reply) for reply in dict.fromkeys(replies))
 
     def get_db_doc(self):
         return {'thread': self.thread_number,
@@ -262,4 +673,6 @@ class Post:
                 'timestamp': self.timestamp,
                 'op': self.op,
                 'message': self.message,
-                'files': self.files}
+                'files': [{field: value for field, value in zip(file._fields, file) if value is not None}
+                          for file in self.files],
+                'replies_to': [reply.number for reply in self.replies]}
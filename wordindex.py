@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import re
+from time import time, strftime, gmtime
+from pymongo import UpdateOne
+from misc import init_config, init_logger, init_dbclient, bulk_write
+
+URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+# Letters only, so numbers, post links and greentext marks are not words
+WORD_RE = re.compile(r'[^\W\d_]+')
+MIN_WORD_LENGTH = 2
+MAX_WORD_LENGTH = 32
+
+
+def tokenize(message):
+    # Distinct lowercased words of a stripped post message
+    words = set()
+    for word in WORD_RE.findall(URL_RE.sub(' ', message).lower().replace('ё', 'е')):
+        if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH:
+            words.add(word)
+    return words
+
+
+def get_day(timestamp):
+    return strftime('%Y-%m-%d', gmtime(timestamp))
+
+
+class WordIndex:
+    # Word -> post numbers postings in the board 'words' collection, split by UTC day into buckets
+    # {word, day, seq, posts, count} of at most bucket_size numbers, so common words do not grow one document.
+    # Only posts saved for the first time are indexed, so a cycle costs as much as its new posts
+    bucket_size = 1000
+
+    def __init__(self, db_link):
+        self.link = db_link['words']
+
+    def ensure_indexes(self):
+        # Buckets of the first version had one document per word and day, they become the first bucket
+        if 'word_1_day_1' in self.link.index_information():
+            self.link.drop_index('word_1_day_1')
+            self.link.update_many({'seq': {'$exists': False}}, {'$set': {'seq': 0}})
+        self.link.create_index([('word', 1), ('day', 1), ('seq', 1)], unique=True)
+        self.link.create_index('day')
+
+    def add_posts(self, posts):
+        postings = {}
+        for post in posts:
+            day = get_day(post.timestamp)
+            for word in tokenize(post.message):
+                postings.setdefault((word, day), []).append(post.number)
+        if not postings:
+            return 0
+        # New numbers fill the last bucket of a word and day before the next bucket is started
+        last_buckets = {}
+        query = {'word': {'$in': list(set(word for word, day in postings))},
+                 'day': {'$in': list(set(day for word, day in postings))}}
+        for bucket in self.link.find(query, {'word': 1, 'day': 1, 'seq': 1, 'count': 1}).sort('seq', 1):
+            last_buckets[(bucket['word'], bucket['day'])] = (bucket['seq'], bucket['count'])
+        requests = []
+        for (word, day), numbers in postings.items():
+            seq, count = last_buckets.get((word, day), (0, 0))
+            while numbers:
+                if count >= self.bucket_size:
+                    seq, count = seq + 1, 0
+                bucket_numbers = numbers[:self.bucket_size - count]
+                numbers = numbers[len(bucket_numbers):]
+                count += len(bucket_numbers)
+                requests.append(UpdateOne({'word': word, 'day': day, 'seq': seq},
+                                          {'$push': {'posts': {'$each': bucket_numbers}},
+                                           '$inc': {'count': len(bucket_numbers)}},
+                                          upsert=True))
+        bulk_write(self.link, requests)
+        return len(requests)
+
+    @staticmethod
+    def get_day_filter(since=None, until=None):
+        day_filter = {}
+        if since:
+            day_filter['$gte'] = get_day(since)
+        if until:
+            day_filter['$lte'] = get_day(until)
+        return {'day': day_filter} if day_filter else {}
+
+    def lookup(self, word, since=None, until=None):
+        # Numbers of posts containing the word, between since and until unix times with day precision
+        query = self.get_day_filter(since, until)
+        query['word'] = word.lower().replace('ё', 'е')
+        numbers = []
+        for bucket in self.link.find(query, {'posts': 1}):
+            numbers.extend(bucket['posts'])
+        return sorted(numbers)
+
+    def find_posts(self, db_link, word, since=None, until=None, limit=0):
+        # Post documents of a lookup, newest first, dead posts included
+        numbers = self.lookup(word, since, until)[::-1]
+        if limit:
+            numbers = numbers[:limit]
+        posts = {}
+        for collection in ('posts', 'dead_posts'):
+            for post in db_link[collection].find({'number': {'$in': numbers}}):
+                posts[post['number']] = post
+        return [posts[number] for number in numbers if number in posts]
+
+    def top_words(self, limit=20, since=None, until=None):
+        # (word, posts count) pairs of the most used words
+        pipeline = [{'$match': self.get_day_filter(since, until)},
+                    {'$group': {'_id': '$word', 'count': {'$sum': '$count'}}},
+                    {'$sort': {'count': -1, '_id': 1}},
+                    {'$limit': limit}]
+        return [(word['_id'], word['count']) for word in self.link.aggregate(pipeline, allowDiskUse=True)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the word index of a board')
+    parser.add_argument('board')
+    parser.add_argument('--word', help='show posts with this word instead of top words')
+    parser.add_argument('--since', type=float, help='unix time of the first day')
+    parser.add_argument('--until', type=float, help='unix time of the last day')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+    config = init_config('config.conf')
+    config.set('global', 'log_file_prefix', 'wordindex')
+    init_logger(config)
+    db_prefix = config.get('global', 'database_prefix', fallback='boardparser')
+    db_link = init_dbclient(config)['{0}_{1}'.format(db_prefix, args.board)]
+    word_index = WordIndex(db_link)
+    start_time = time()
+    if args.word:
+        for post in word_index.find_posts(db_link, args.word, args.since, args.until, args.limit):
+            print('#{0} {1} {2}'.format(post['number'], get_day(post['timestamp']), post['message'][:200]))
+    else:
+        for word, count in word_index.top_words(args.limit, args.since, args.until):
+            print('{0} {1}'.format(count, word))
+    logging.debug('Queried /{0}/ words in {1:.3f} seconds'.format(args.board, time() - start_time))
+
+
+if __name__ == '__main__':
+    main()